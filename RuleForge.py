@@ -5,49 +5,628 @@ import sys
 import json
 from operator import itemgetter
 import os
-
-from symspellpy.editdistance import EditDistance, DistanceAlgorithm
+import multiprocessing
+import mmap
+import struct
+import hashlib
+import gzip
+from datetime import datetime, timezone
+from itertools import chain
+from contextlib import contextmanager, nullcontext
+import functools
+import importlib
+import resource
+import time
+
+#symspellpy, sklearn and scipy take most of the startup time, they are imported by the methods using them
+from rapidfuzz.process import cdist
+from rapidfuzz.distance import Levenshtein as RapidfuzzLevenshtein
 
 
 import numpy as np
-import difflib
 
 
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.cluster import AffinityPropagation
+import Levenshtein as lev
 
 
-import Levenshtein as lev
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+#symspell dictionary with words and their indices, shared with forked worker processes looking up neighbourhoods
+_neighbourhood_lookup = None
+
+#symspell neighbourhoods of words between start and end, as neighbourhood sizes and concatenated word indices
+def _lookup_neighbourhoods(bounds):
+    from symspellpy import Verbosity
+    sym_spell, words, word_index, max_distance = _neighbourhood_lookup
+    start, end = bounds
+    neighbourhoods = [[word_index[suggestion.term] for suggestion in sym_spell.lookup(word, Verbosity.ALL, max_edit_distance=max_distance)] for word in words[start:end]]
+    sizes = np.fromiter(map(len, neighbourhoods), dtype=np.uint32, count=len(neighbourhoods))
+    return sizes, np.fromiter(chain.from_iterable(neighbourhoods), dtype=np.uint32, count=int(sizes.sum()))
 
 
-from collections import Counter
+#rule generator shared with forked worker processes generating rules from clusters
+_rule_generator = None
+
+#rule counters of batch of clusters given as (index, method, label, passwords in cluster, representative)
+#returned with the number of rule cache hits, misses and rule search steps of the batch
+def _cluster_rule_counters(batch):
+    rule_generator = _rule_generator
+    hits, misses, steps = rule_generator.rule_cache_hits, rule_generator.rule_cache_misses, rule_generator.rule_search_steps
+    counters = []
+    for index, method, label, passwords_in_cluster, representative in batch:
+        if method == "substring":
+            rules = rule_generator.rules_from_cluster_substr(label, passwords_in_cluster)
+        else:
+            rules = rule_generator.rules_from_cluster_classic(label, passwords_in_cluster, representative)
+        counters.append((index, Counter(rules)))
+    return counters, rule_generator.rule_cache_hits - hits, rule_generator.rule_cache_misses - misses, rule_generator.rule_search_steps - steps
+
+
+#rule counter and kept clusters of one chunk of passwords, computed in forked process with its own distance matrix
+#returned with rule cache hits, misses, rule search steps and profile of the chunk
+def _chunk_rule_counter(chunk_index):
+    rule_generator = _rule_generator
+    rule_generator.chunk_index = chunk_index
+    rule_generator.rules = rule_generator.rule_counter()
+    rule_generator.sweep_rules = {threshold: rule_generator.rule_counter() for threshold in rule_generator.sweep_rules}
+    rule_generator.cluster_passes = []
+    rule_generator.sweep_cluster_passes = {threshold: [] for threshold in rule_generator.sweep_cluster_passes}
+    #chunk process neither spawns rule workers nor takes all cores for distances
+    rule_generator.jobs = 1
+    rule_generator.distance_workers = max(1, (os.cpu_count() or 1) // rule_generator.chunk_jobs)
+    #stages of chunk are profiled separately and added to profile of the run
+    rule_generator.profile = StageProfile() if rule_generator.profile is not None else None
+    hits, misses, steps = rule_generator.rule_cache_hits, rule_generator.rule_cache_misses, rule_generator.rule_search_steps
+    rule_generator.chunk_edit_distance()
+    if rule_generator.distance_thresholds:
+        chunk_rules, chunk_cluster_passes = rule_generator.sweep_rules, rule_generator.sweep_cluster_passes
+    else:
+        chunk_rules, chunk_cluster_passes = rule_generator.rules, rule_generator.cluster_passes
+    statistics = (rule_generator.rule_cache_hits - hits, rule_generator.rule_cache_misses - misses, rule_generator.rule_search_steps - steps, rule_generator.profile)
+    return chunk_rules, chunk_cluster_passes, statistics
+
+#rules of one wordlist of batch processed by forked worker, rule memo of worker is kept for its next wordlists
+#returned with run metadata, rule cache hits, misses, rule search steps and profile of the wordlist
+def _batch_rule_counter(wordlist):
+    rule_generator = _rule_generator
+    generator = rule_generator.batch_generator(wordlist)
+    #wordlists processed at once share the cores computing distances
+    generator.distance_workers = max(1, (os.cpu_count() or 1) // rule_generator.batch_jobs)
+    generator.process_passwords()
+    metadata = generator.run_metadata() if rule_generator.combined else None
+    statistics = (generator.rule_cache_hits, generator.rule_cache_misses, generator.rule_search_steps, generator.profile)
+    return generator.rules if rule_generator.combined else None, metadata, statistics
+
+
+#eps neighbourhoods of words in CSR layout, neighbours of word i are indices[offsets[i]:offsets[i + 1]]
+#arrays are held in memory or memory-mapped from binary cache file, which is read lazily
+#cache file layout (little endian): header, word offsets (uint64, words + 1), utf-8 word table padded to 8 bytes,
+#neighbour offsets (uint64, words + 1), neighbour indices (uint32)
+class Neighbourhoods:
+    MAGIC = b'RFNBHD\x00\x01'
+    HEADER = struct.Struct('<8sI4xQQQ32s') #magic, eps, word count, neighbour count, word table size, sha256 of wordlist
+
+    def __init__(self, offsets, indices, word_offsets=None, word_table=None, mapping=None):
+        self.offsets = offsets
+        self.indices = indices
+        self.word_offsets = word_offsets
+        self.word_table = word_table
+        self.mapping = mapping #open mmap of cache file
+
+    @classmethod
+    def from_sizes(cls, sizes, indices):
+        offsets = np.zeros(len(sizes) + 1, dtype=np.uint64)
+        np.cumsum(sizes, out=offsets[1:])
+        return cls(offsets, indices)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.indices[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    #number of neighbours of word i, word itself included
+    def size(self, i):
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    #word i from word table of cache file
+    def word(self, i):
+        return bytes(self.word_table[self.word_offsets[i]:self.word_offsets[i + 1]]).decode('utf-8', errors='surrogateescape')
+
+    #write neighbourhoods with word table to binary cache file
+    def save(self, path, words, eps, wordlist_hash):
+        encoded_words = [word.encode('utf-8', errors='surrogateescape') for word in words]
+        word_offsets = np.zeros(len(words) + 1, dtype='<u8')
+        np.cumsum(np.fromiter(map(len, encoded_words), dtype=np.uint64, count=len(words)), out=word_offsets[1:])
+        word_table = b''.join(encoded_words)
+
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(self.HEADER.pack(self.MAGIC, eps, len(words), len(self.indices), len(word_table), wordlist_hash))
+            file.write(word_offsets.tobytes())
+            file.write(word_table + b'\x00' * (-len(word_table) % 8))
+            file.write(self.offsets.astype('<u8').tobytes())
+            file.write(self.indices.astype('<u4').tobytes())
+        os.replace(temporary_path, path)
+
+    #memory-map binary cache file, None when file is missing, truncated or belongs to another wordlist or eps
+    @classmethod
+    def load(cls, path, eps, wordlist_hash):
+        try:
+            with open(path, 'rb') as file:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(mapping) < cls.HEADER.size:
+            mapping.close()
+            return None
+        magic, cached_eps, word_count, neighbour_count, word_table_size, cached_hash = cls.HEADER.unpack_from(mapping)
+        size = cls.HEADER.size + 16 * (word_count + 1) + word_table_size + (-word_table_size % 8) + 4 * neighbour_count
+        if magic != cls.MAGIC or cached_eps != eps or cached_hash != wordlist_hash or size != len(mapping):
+            mapping.close()
+            return None
+
+        position = cls.HEADER.size
+        word_offsets = np.frombuffer(mapping, dtype='<u8', count=word_count + 1, offset=position)
+        position += word_offsets.nbytes
+        word_table = memoryview(mapping)[position:position + word_table_size]
+        position += word_table_size + (-word_table_size % 8)
+        offsets = np.frombuffer(mapping, dtype='<u8', count=word_count + 1, offset=position)
+        position += offsets.nbytes
+        indices = np.frombuffer(mapping, dtype='<u4', count=neighbour_count, offset=position)
+        return cls(offsets, indices, word_offsets, word_table, mapping)
+
+    #read JSON cache of MDBSCAN (word -> neighbour words), None when it does not hold exactly the given words
+    @classmethod
+    def from_mdbscan_json(cls, path, words):
+        try:
+            with open(path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+                cached = json.load(file)
+        except (OSError, ValueError):
+            return None
+        word_index = {word: i for i, word in enumerate(words)}
+        if len(cached) != len(words) or any(word not in cached for word in words):
+            return None
+        try:
+            neighbourhoods = [[word_index[neighbour] for neighbour in cached[word]] for word in words]
+        except KeyError:
+            return None
+        sizes = np.fromiter(map(len, neighbourhoods), dtype=np.uint32, count=len(neighbourhoods))
+        return cls.from_sizes(sizes, np.fromiter(chain.from_iterable(neighbourhoods), dtype=np.uint32, count=int(sizes.sum())))
 
 
 
+#wall time, CPU time and peak RSS of stages of run and counters of its work, for --profile report
+#time of stage does not include time of stages nested in it, so stage times add up to profiled time
+#peak RSS is high-water mark of process at the end of stage, the stage that raised it first holds the highest one
+class StageProfile:
+    def __init__(self):
+        self.stages = {} #name -> {'calls', 'wall_time', 'cpu_time', 'peak_rss_kb'}
+        self.counters = Counter()
+        self.running = [] #names of entered stages, innermost last
+        self.started = (time.perf_counter(), time.process_time())
+        self.resumed = self.started
+
+    #charge time since last resume to innermost running stage
+    def pause(self):
+        wall, cpu = time.perf_counter(), time.process_time()
+        if self.running:
+            stage = self.stages[self.running[-1]]
+            stage['wall_time'] += wall - self.resumed[0]
+            stage['cpu_time'] += cpu - self.resumed[1]
+        self.resumed = (wall, cpu)
+
+    @contextmanager
+    def stage(self, name):
+        self.pause()
+        stage = self.stages.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_kb': 0})
+        stage['calls'] += 1
+        self.running.append(name)
+        try:
+            yield
+        finally:
+            self.pause()
+            self.running.pop()
+            stage['peak_rss_kb'] = max(stage['peak_rss_kb'], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    #add stages and counters of profile from worker process
+    def merge(self, profile):
+        for name, other in profile.stages.items():
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_kb': 0})
+            stage['calls'] += other['calls']
+            stage['wall_time'] += other['wall_time']
+            stage['cpu_time'] += other['cpu_time']
+            stage['peak_rss_kb'] = max(stage['peak_rss_kb'], other['peak_rss_kb'])
+        self.counters.update(profile.counters)
+
+    def report(self):
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            'wall_time': time.perf_counter() - self.started[0],
+            'cpu_time': time.process_time() - self.started[1],
+            'children_cpu_time': children.ru_utime + children.ru_stime,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'stages': self.stages,
+            'counters': dict(self.counters),
+        }
+
+#method runs as stage of profile of its generator, it is called directly when run is not profiled
+def profiled_stage(name):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profile is None:
+                return method(self, *args, **kwargs)
+            with self.profile.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+#Space-Saving heavy hitters (Metwally et al.), rule counts in bounded memory of at most capacity rules
+#when counter is full, new rule replaces rule with the lowest count and inherits its count as error
+#count of tracked rule overestimates its frequency by at most its error <= total / capacity and every rule
+#more frequent than total / capacity is tracked, counts are exact while no rule has been replaced
+#rules are ordered by count and then by order of first tracking, like Counter.most_common
+class SpaceSavingCounter:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {} #rule -> count, in order of tracking
+        self.errors = {} #rule -> maximum overestimation of its count
+        self.buckets = {} #count -> rules with that count, in order of reaching it
+        self.min_count = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def values(self):
+        return self.counts.values()
+
+    def items(self):
+        return self.counts.items()
+
+    #count rules from iterable or add counts from mapping
+    #counts of other Space-Saving counter come with their errors, the merged count overestimates by their sum
+    def update(self, rules):
+        if isinstance(rules, SpaceSavingCounter):
+            for rule, count in rules.items():
+                self.add(rule, count, rules.errors[rule])
+            self.evictions += rules.evictions
+        elif hasattr(rules, 'items'):
+            for rule, count in rules.items():
+                self.add(rule, count)
+        else:
+            for rule in rules:
+                self.add(rule, 1)
+
+    def add(self, rule, count, error=0):
+        old_count = self.counts.get(rule)
+        if old_count is None:
+            if len(self.counts) < self.capacity:
+                old_count = 0
+                self.errors[rule] = error
+            else:
+                #replace the oldest rule with the lowest count
+                evicted = next(iter(self.buckets[self.min_count]))
+                old_count = self.min_count
+                self.remove_from_bucket(evicted, old_count)
+                del self.counts[evicted]
+                del self.errors[evicted]
+                self.errors[rule] = old_count + error
+                self.evictions += 1
+        else:
+            self.remove_from_bucket(rule, old_count)
+            self.errors[rule] += error
+
+        new_count = old_count + count
+        self.counts[rule] = new_count
+        self.buckets.setdefault(new_count, {})[rule] = None
+        if new_count < self.min_count or len(self.counts) == 1:
+            self.min_count = new_count
+        elif self.min_count not in self.buckets:
+            #rule left the only bucket with the lowest count, by one count it moved just above it
+            self.min_count = new_count if count == 1 else min(self.buckets)
+
+    def remove_from_bucket(self, rule, count):
+        bucket = self.buckets[count]
+        del bucket[rule]
+        if not bucket:
+            del self.buckets[count]
+
+    def exact(self):
+        return self.evictions == 0
+
+    #largest possible overestimation of any tracked count
+    def max_error(self):
+        return max(self.errors.values(), default=0)
+
+    def most_common(self, n=None):
+        ranked = sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        return ranked if n is None else ranked[:n]
+
+
+#Affinity propagation on int8 edit distance matrix with float32 responsibility and availability matrices
+#messages are updated in place by blocks of rows, so working set is two float32 matrices, float16 similarity
+#and a few blocks of rows, instead of float64 matrices and their temporaries in sklearn
+#port of sklearn.cluster.affinity_propagation with the same damping, convergence_iter and max_iter semantics,
+#similarity is negative distance in float16 with the same noise sklearn adds to float16 similarity from AP_clustering
+#and preference is median similarity
+class LeanAffinityPropagation:
+    def __init__(self, damping=0.5, convergence_iter=15, max_iter=200, block_size=1024, random_state=None):
+        self.damping = damping
+        self.convergence_iter = convergence_iter
+        self.max_iter = max_iter
+        self.block_size = block_size
+        self.random_state = random_state
+
+    def fit_predict(self, distance_matrix):
+        return self.fit(distance_matrix).labels_
+
+    def fit(self, distance_matrix):
+        n = len(distance_matrix)
+        blocks = [(start, min(start + self.block_size, n)) for start in range(0, n, self.block_size)]
+        self.n_iter_ = 0
+        if n == 1:
+            self.cluster_centers_indices_, self.labels_ = np.array([0]), np.array([0])
+            return self
+
+        preference = -self.median_distance(distance_matrix, blocks)
+        similarity = np.empty((n, n), dtype=np.float16)
+        lowest, highest = np.inf, -np.inf
+        for start, end in blocks:
+            block = similarity[start:end]
+            block[:] = distance_matrix[start:end]
+            np.negative(block, out=block)
+            rows = np.arange(end - start)
+            #equal similarities are checked without diagonal
+            block[rows, rows + start] = np.nan
+            lowest = min(lowest, np.nanmin(block))
+            highest = max(highest, np.nanmax(block))
+            block[rows, rows + start] = preference
+        if lowest == highest:
+            #it makes no sense to run the algorithm, every password is its own cluster or all are in one cluster
+            if preference > lowest:
+                self.cluster_centers_indices_, self.labels_ = np.arange(n), np.arange(n)
+            else:
+                self.cluster_centers_indices_, self.labels_ = np.array([0]), np.zeros(n, dtype=np.int64)
+            return self
+
+        #remove degeneracies, random state is resolved like sklearn.utils.check_random_state does
+        if self.random_state is None:
+            random_state = np.random.mtrand._rand
+        elif isinstance(self.random_state, np.random.RandomState):
+            random_state = self.random_state
+        else:
+            random_state = np.random.RandomState(self.random_state)
+        eps, tiny = np.finfo(np.float16).eps, np.finfo(np.float16).tiny
+        for start, end in blocks:
+            block = similarity[start:end]
+            block += (eps * block + tiny * 100) * random_state.standard_normal(size=block.shape)
+
+        responsibility = np.zeros((n, n), dtype=np.float32)
+        availability = np.zeros((n, n), dtype=np.float32)
+        damping = np.float32(self.damping)
+        exemplar_history = np.zeros((n, self.convergence_iter), dtype=bool)
+        diagonal = np.arange(n)
+        for iteration in range(self.max_iter):
+            #responsibilities
+            for start, end in blocks:
+                rows = np.arange(end - start)
+                block = availability[start:end] + similarity[start:end]
+                best = np.argmax(block, axis=1)
+                best_value = block[rows, best]
+                block[rows, best] = -np.inf
+                second_value = np.max(block, axis=1)
+                np.subtract(similarity[start:end], best_value[:, None], out=block)
+                block[rows, best] = similarity[start:end][rows, best] - second_value
+                block *= 1 - damping
+                responsibility[start:end] *= damping
+                responsibility[start:end] += block
+
+            #availabilities, from column sums of positive responsibilities
+            column_sums = np.zeros(n, dtype=np.float64)
+            for start, end in blocks:
+                column_sums += self.positive_responsibility(responsibility, start, end).sum(axis=0, dtype=np.float64)
+            column_sums = column_sums.astype(np.float32)
+            for start, end in blocks:
+                rows = np.arange(end - start)
+                block = self.positive_responsibility(responsibility, start, end)
+                block -= column_sums
+                self_availability = block[rows, rows + start].copy()
+                np.maximum(block, 0, out=block)
+                block[rows, rows + start] = self_availability
+                block *= 1 - damping
+                availability[start:end] *= damping
+                availability[start:end] -= block
+
+            #check for convergence
+            exemplars = (availability[diagonal, diagonal] + responsibility[diagonal, diagonal]) > 0
+            exemplar_history[:, iteration % self.convergence_iter] = exemplars
+            self.n_iter_ = iteration + 1
+            if iteration >= self.convergence_iter:
+                stable = np.sum(exemplar_history, axis=1)
+                converged = np.sum((stable == self.convergence_iter) + (stable == 0)) == n
+                if converged and np.sum(exemplars) > 0:
+                    break
+
+        del responsibility, availability
+        centers = np.flatnonzero(exemplars)
+        if centers.size == 0:
+            self.cluster_centers_indices_, self.labels_ = np.array([], dtype=np.int64), np.full(n, -1)
+            return self
+
+        #refine exemplars, each cluster takes member with the highest similarity sum of members, summed in float16 like sklearn
+        nearest = self.nearest_exemplar(similarity, centers, blocks)
+        members = np.argsort(nearest, kind='stable')
+        for k, indices in enumerate(np.split(members, np.flatnonzero(np.diff(nearest[members])) + 1)):
+            centers[k] = indices[np.argmax(np.sum(similarity[indices[:, None], indices], axis=0))]
+
+        labels = centers[self.nearest_exemplar(similarity, centers, blocks)]
+        self.cluster_centers_indices_ = np.unique(labels)
+        self.labels_ = np.searchsorted(self.cluster_centers_indices_, labels)
+        return self
+
+    #median of all distances counted by values, without sorting copy of matrix
+    def median_distance(self, distance_matrix, blocks):
+        counts = np.zeros(256, dtype=np.int64)
+        for start, end in blocks:
+            counts += np.bincount((distance_matrix[start:end].astype(np.int16) + 128).ravel(), minlength=256)
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        lower = np.searchsorted(cumulative, (total - 1) // 2, side='right') - 128
+        upper = np.searchsorted(cumulative, total // 2, side='right') - 128
+        return (lower + upper) / 2
+
+    #responsibilities of rows between start and end, negative ones are zero except self-responsibilities
+    def positive_responsibility(self, responsibility, start, end):
+        rows = np.arange(end - start)
+        block = np.maximum(responsibility[start:end], 0)
+        block[rows, rows + start] = responsibility[start:end][rows, rows + start]
+        return block
+
+    #position of the most similar exemplar of every row, exemplars point to themselves
+    def nearest_exemplar(self, similarity, centers, blocks):
+        nearest = np.empty(len(similarity), dtype=np.int64)
+        for start, end in blocks:
+            nearest[start:end] = np.argmax(similarity[start:end][:, centers], axis=1)
+        nearest[centers] = np.arange(len(centers))
+        return nearest
+
+
+#rule counts file - JSON, gzip compressed when file name ends with .gz, with rules and their counts in order of first
+#occurrence, number of counted rules, upper bound of count overestimation and metadata of runs the counts come from
+RULE_COUNTS_FORMAT = 'ruleforge-rule-counts'
+RULE_COUNTS_VERSION = 1
+
+def open_json_document(path, mode, compressed):
+    if compressed:
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def save_rule_counts(path, counter, sources, max_error=0):
+    document = {
+        'format': RULE_COUNTS_FORMAT,
+        'version': RULE_COUNTS_VERSION,
+        'total': sum(counter.values()),
+        'exact': max_error == 0,
+        'max_error': max_error,
+        'sources': sources,
+        'rules': list(counter.items()),
+    }
+    temporary_path = path + '.tmp'
+    with open_json_document(temporary_path, 'w', path.endswith('.gz')) as file:
+        json.dump(document, file, separators=(',', ':'))
+    os.replace(temporary_path, path)
+
+#rule counter and the rest of the document, ValueError when file is not rule counts file
+def load_rule_counts(path):
+    with open_json_document(path, 'r', path.endswith('.gz')) as file:
+        document = json.load(file)
+    if not isinstance(document, dict) or document.get('format') != RULE_COUNTS_FORMAT:
+        raise ValueError(f'{path} is not a rule counts file')
+    if document.get('version') != RULE_COUNTS_VERSION:
+        raise ValueError(f'{path} has unsupported version {document.get("version")}')
+    counter = Counter()
+    for rule, count in document.pop('rules', []):
+        counter[rule] += count
+    return counter, document
+
+
+#clusters file - JSON like rule counts file, with clusters of every rule generation pass as [label, representative, passwords]
+#passes are chunks clustered one after another ('chunks') or one pass over clusters of whole wordlist ('external')
+CLUSTERS_FORMAT = 'ruleforge-clusters'
+CLUSTERS_VERSION = 1
+
+def save_clusters(path, passes, order, sources):
+    document = {
+        'format': CLUSTERS_FORMAT,
+        'version': CLUSTERS_VERSION,
+        'order': order,
+        'sources': sources,
+        'passes': passes,
+    }
+    temporary_path = path + '.tmp'
+    with open_json_document(temporary_path, 'w', path.endswith('.gz')) as file:
+        json.dump(document, file, separators=(',', ':'))
+    os.replace(temporary_path, path)
+
+#clusters document, ValueError when file is not clusters file
+def load_clusters(path):
+    with open_json_document(path, 'r', path.endswith('.gz')) as file:
+        document = json.load(file)
+    if not isinstance(document, dict) or document.get('format') != CLUSTERS_FORMAT:
+        raise ValueError(f'{path} is not a clusters file')
+    if document.get('version') != CLUSTERS_VERSION:
+        raise ValueError(f'{path} has unsupported version {document.get("version")}')
+    return document
+
+
 class RuleGenerator:
     def __init__(self):
         self.wordlist = None #input wordlist file
         self.rule_file = None #output rule file
+        self.most_frequent = None #number of saved rules, None saves as many rules as the first chunk gave
 
         #clustering options
         self.DBSCAN = False
         self.HAC = False
         self.AP = False
         self.MDBSCAN = False
+        self.hac_sparse = False
+        self.STDIN = False
+        self.representative = None
+        self.remove_outliers = False
+        self.loaded_clusters = None #clusters file rules are generated from instead of clustering
+        self.batch_wordlists = None #wordlists processed one after another with --wordlist_dir or --manifest
+        self.combined = False #also save ranking of rules of all wordlists of batch
+        self.batch_jobs = 1 #number of wordlists of batch processed at once
+        self.args = None #parsed arguments, each wordlist of batch is configured by copy of them
 
         self.passwords = []  #passwors from wordlist file
         self.distance_matrix = [] #distance matrix with various edit distances of passwords
         self.clusters = {}
         self.cluster_representatives = {}
+        self.cluster_indices = {} #chunk indices of passwords of each cluster from distance matrix
         self.chunks = [] #chunks of passwords, used for chunking large input file
         self.chunk_size = 10000 #size of one chunk
         self.chunk_index = 0 
+        self.distance_block_size = 1024 #number of matrix rows computed at once by the batched engine
+        self.distance_workers = -1 #threads computing distances with rapidfuzz, -1 uses all cores
+        self.chunk_jobs = 1 #number of chunks processed at once
+        self.ap_engine = 'sklearn' #affinity propagation implementation, sklearn or lean
+        self.distance_engine = 'batched' #distance matrix engine, batched or symspell
+        self.distance_matrix_order = None #chunk indices in the order of distance matrix rows, None when it is the chunk order
+        self.precomputed_distance_matrix = None #memory-mapped distance matrix of whole wordlist, with --distance_matrix_precomputed
+        self.neighbourhood_cache = True #cache symspell neighbourhoods next to wordlist
+        self.distance_thresholds = None #HAC threshold sweep, each threshold gets its own rules and rule file
+        self.sweep_rules = {} #threshold -> rule counter of sweep
+        self.sweep_most_frequent = {} #threshold -> number of saved rules of sweep
+        self.sweep_cluster_passes = {} #threshold -> clusters of rule generation passes of sweep
         
 
-        self.rules = [] #generated rules
+        self.rules = Counter() #generated rules and their counts, counted as they are generated
+        self.rule_counter_size = None #maximum number of counted rules, None counts all rules exactly
+        self.counts_file = None #output file with rule counts and run metadata, for merging runs
+        self.clusters_file = None #output file with clusters of every rule generation pass, rules are regenerated from it
+        self.cluster_passes = [] #clusters of rule generation passes kept for clusters_file
+        self.cluster_order = 'chunks' #how the passes were generated, see save_clusters
         self.rules_priority = {}
-
-        self.edit_distance_calculator = EditDistance(DistanceAlgorithm.LEVENSHTEIN_FAST) #init distance matrix calculator
+        self.rule_search = [] #rule candidates in priority order, see compile_rule_search
+        self.rule_priority_fingerprint = None #digest of the rule priority the candidates were compiled from
+        self.rule_cache = OrderedDict() #LRU memo of generate_hashcat_rules, (fingerprint, representative, password) -> rules
+        self.rule_cache_size = 100000 #maximum number of memoized transformations, 0 disables the memo
+        self.rule_cache_hits = 0
+        self.rule_cache_misses = 0
+        self.rule_search_steps = 0 #number of single rules searched for
+        self.profile = None #StageProfile of run with --profile
+        self.profile_file = None #output file of profile report
+        self.verbose = False
+        self.jobs = 1 #number of processes generating rules from clusters
+
+        self.edit_distance_calculator = None #symspell distance calculator, see symspell_edit_distance
 
         #functions representing each rule
         self.lambda_functions = {
@@ -87,17 +666,32 @@ class RuleGenerator:
     
     
 
-    #parse input arguments
-    def process_args(self):
+    #parse input arguments, command line arguments are used when argv is None
+    def process_args(self, argv=None):
             parser = argparse.ArgumentParser(prog='RuleGenerator')
             parser.add_argument('--wordlist', nargs=1)
             parser.add_argument('--rulefile', nargs=1, required=True)
+            parser.add_argument('--counts_file', nargs=1) #also save rule counts, runs are combined with merge_rule_counts.py
+            parser.add_argument('--save_clusters', nargs=1) #also save clusters and representatives, rules are regenerated with --load_clusters
+            parser.add_argument('--load_clusters', nargs=1) #skip clustering, generate rules from clusters saved by --save_clusters
+            parser.add_argument('--wordlist_dir', nargs=1) #process every .txt wordlist of directory in one run, rules.rule -> rules.<wordlist>.rule
+            parser.add_argument('--manifest', nargs=1) #process wordlists listed in file (one path per line, relative to the file) like --wordlist_dir
+            parser.add_argument('--combined', action='store_true') #with --wordlist_dir or --manifest also save ranking of rules of all wordlists to --rulefile
+            parser.add_argument('--batch_jobs', type=int, default=1) #number of wordlists of --wordlist_dir or --manifest processed at once
 
             #when true skip distance matrix computation, use precomputed matrix
             parser.add_argument('--distance_matrix_precomputed', action='store_true')
 
+            #engine used for computing distance matrix - batched (multi-core rapidfuzz) or symspell (original pure-python loop)
+            parser.add_argument('--distance_engine', choices=['batched', 'symspell'], default='batched')
+
+            #when true HAC compares only passwords with length difference below distance_threshold, other distances are saturated
+            parser.add_argument('--distance_pruning', action='store_true')
+
             #when true generate n most frequent rules
             parser.add_argument('--most_frequent', nargs=1)
+            #count at most this many rules with Space-Saving heavy hitters, exact top rules while memory allows
+            parser.add_argument('--rule_counter_size', type=int)
 
             #DBSCAN
             parser.add_argument('--dbscan', action='store_true') #cluster with DBSCAN
@@ -107,25 +701,36 @@ class RuleGenerator:
             #HAC
             parser.add_argument('--hac', action='store_true') #cluster with HAC
             parser.add_argument('--distance_threshold', type=int, default=3) #the linkage distance threshold at or above which clusters will not be merged - int
+            parser.add_argument('--hac_sparse', action='store_true') #single linkage on sparse neighbour graph, whole wordlist without chunking
+            parser.add_argument('--distance_thresholds', type=int, nargs='+') #sweep of thresholds clustered from one spanning tree per chunk, one rule file per threshold
 
             #Affinity propagation
             parser.add_argument('--ap', action='store_true')  #cluster with AP
             parser.add_argument('--convergence_iter', type=int, default=15) #number of iterations to wait for convergence - int
             parser.add_argument('--damping', type=float, default=0.7) #damping factor between 0.5 and 1 - float
+            parser.add_argument('--ap_engine', choices=['sklearn', 'lean'], default='sklearn') #lean keeps float32 messages updated in place
 
             #MDBSCAN
             parser.add_argument('--mdbscan', action='store_true') #cluster with MDBSCAN
             parser.add_argument('--eps1', type=int, default=1)  #the maximum distance between two samples for one to be considered as in the neighborhood of the other - int
             parser.add_argument('--eps2', type=float, default=0.25)  #jaro-winkler cluster shaping
 
+            #DBSCAN, MDBSCAN and sparse HAC cache symspell neighbourhoods in binary file next to wordlist
+            parser.add_argument('--no_neighbourhood_cache', action='store_true')
+
 
             parser.add_argument('--rule_priority', nargs=1)  #use custom rule priority
+            parser.add_argument('--rule_cache_size', type=int, default=100000) #number of memoized (representative, password) transformations, 0 disables the memo
 
 
             parser.add_argument('--remove_outliers',action='store_true') #do not use outliers for rule generation
             parser.add_argument('--stdin',action='store_true')
+            parser.add_argument('--stream',action='store_true') #with --stdin generate rules from each cluster as soon as it is read
 
             parser.add_argument('--verbose',action='store_true', help='Prints out information about rule generating process.') #verbose mode
+            parser.add_argument('--profile', nargs=1) #save JSON report with time and memory of each stage and counters of work done
+            parser.add_argument('--jobs', type=int, default=1) #number of processes generating rules from clusters, 0 uses all cores
+            parser.add_argument('--chunk_jobs', type=int, default=1) #number of HAC and AP chunks processed at once, each holds its own distance matrix
 
 
             parser.add_argument(
@@ -135,60 +740,135 @@ class RuleGenerator:
                 help="Choose the method for selecting a representative: combo, levenshtein, or substring"
             )
 
-            args = parser.parse_args()
-
-            if args.wordlist:
+            self.apply_args(parser.parse_args(argv))
+
+    #settings of parsed arguments, wordlists of batch are listed only here
+    def apply_args(self, args):
+            self.args = args
+
+            self.loaded_clusters = args.load_clusters[0] if args.load_clusters else None
+            if args.wordlist_dir or args.manifest:
+                if args.wordlist or args.stdin or self.loaded_clusters or (args.wordlist_dir and args.manifest):
+                    print('Batch of wordlists is given by one --wordlist_dir or --manifest, not together with other input.', file=sys.stderr)
+                    exit(1)
+                try:
+                    self.batch_wordlists = self.list_wordlists(args.wordlist_dir[0]) if args.wordlist_dir else self.read_manifest(args.manifest[0])
+                except OSError as error:
+                    print(f'Cannot read wordlists: {error}', file=sys.stderr)
+                    exit(1)
+                if not self.batch_wordlists:
+                    print('No wordlists to process.', file=sys.stderr)
+                    exit(1)
+                self.combined = args.combined
+                self.batch_jobs = max(1, args.batch_jobs)
+            elif args.wordlist:
                 self.wordlist = args.wordlist[0]
-            elif not args.stdin:
+            elif not (args.stdin or self.loaded_clusters):
                 print('You must select a wordfile.',file=sys.stderr)
                 exit(1)
             
             self.rule_file = args.rulefile[0]
+            self.counts_file = args.counts_file[0] if args.counts_file else None
+            self.clusters_file = args.save_clusters[0] if args.save_clusters else None
 
             self.most_frequent = int(args.most_frequent[0]) if args.most_frequent else None
+            if args.rule_counter_size is not None:
+                if args.rule_counter_size < 1:
+                    print('Rule counter size must be positive.', file=sys.stderr)
+                    exit(1)
+                #at least most_frequent rules have to be tracked
+                self.rule_counter_size = max(args.rule_counter_size, self.most_frequent or 0)
+                self.rules = self.rule_counter()
 
             self.rule_priority_file = args.rule_priority[0] if args.rule_priority else None
+            self.rule_cache_size = max(0, args.rule_cache_size)
 
             
 
             self.DBSCAN = args.dbscan
-            self.min_points = args.min_points if self.DBSCAN else None 
+            self.min_points = args.min_points if (self.DBSCAN or args.mdbscan) else None 
             self.eps = args.eps if self.DBSCAN else None  
             self.remove_outliers = args.remove_outliers
     
             self.HAC = args.hac
             self.distance_threshold = args.distance_threshold if self.HAC else None
+            self.hac_sparse = args.hac_sparse and self.HAC
+            if self.HAC and args.distance_thresholds:
+                if self.hac_sparse:
+                    print('Threshold sweep needs distance matrix, it cannot be used with --hac_sparse.', file=sys.stderr)
+                    exit(1)
+                self.distance_thresholds = sorted(set(args.distance_thresholds))
+                #matrix is computed once for the largest threshold
+                self.distance_threshold = self.distance_thresholds[-1]
 
             self.AP = args.ap
             self.convergence_iter = args.convergence_iter if self.AP else None
             self.dampning = args.damping if self.AP else None
+            self.ap_engine = args.ap_engine
 
 
             self.MDBSCAN = args.mdbscan
             self.eps1 = args.eps1 if self.MDBSCAN else None
             self.eps2 = args.eps2 if self.MDBSCAN else None
+            self.neighbourhood_cache = not args.no_neighbourhood_cache
 
             self.dm_precomputed = args.distance_matrix_precomputed
+            self.distance_engine = args.distance_engine
+            self.distance_pruning = args.distance_pruning and self.HAC and 1 <= self.distance_threshold <= 100 and not args.distance_matrix_precomputed
 
             self.STDIN = args.stdin
+            self.stream = args.stream and self.STDIN
 
             self.representative = args.representative
             self.verbose = args.verbose
+            if args.profile:
+                self.profile_file = args.profile[0]
+                self.profile = StageProfile()
+            self.jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+            self.chunk_jobs = max(1, args.chunk_jobs)
+
+            if self.distance_thresholds:
+                self.sweep_rules = {threshold: self.rule_counter() for threshold in self.distance_thresholds}
+                self.sweep_most_frequent = {threshold: self.most_frequent for threshold in self.distance_thresholds}
+                self.sweep_cluster_passes = {threshold: [] for threshold in self.distance_thresholds}
+
+            if self.clusters_file is not None and self.stream:
+                print('Streamed clusters are not kept, clusters from stdin can be reused as they are.', file=sys.stderr)
+                exit(1)
+
+            if self.combined and self.distance_thresholds:
+                print('Combined ranking of batch is not made for threshold sweep, merge counts files of each threshold with merge_rule_counts.py.', file=sys.stderr)
+                exit(1)
 
 
-            if not (self.DBSCAN or self.HAC or self.AP or self.MDBSCAN or self.STDIN):
+            if not (self.DBSCAN or self.HAC or self.AP or self.MDBSCAN or self.STDIN or self.loaded_clusters):
                 print("No clustering method specified", file=sys.stderr)
                 exit(1)
 
 
     #load passwords from input wordlist 
     def process_passwords(self):
+        if self.batch_wordlists is not None:
+            self.process_batch()
+            return
+
+        if self.loaded_clusters:
+            try:
+                with self.stage('load'):
+                    document = load_clusters(self.loaded_clusters)
+            except (OSError, ValueError) as error:
+                print(f'Cannot read clusters: {error}', file=sys.stderr)
+                exit(1)
+            self.rules_from_saved_clusters(document)
+            self.save_frequent_rules_to_file()
+            return
+
         if self.STDIN:
             self.external_clustering()
             return
 
         try:
-            with open(self.wordlist,'r', encoding='utf-8', errors='surrogateescape') as file:
+            with self.stage('load'), open(self.wordlist,'r', encoding='utf-8', errors='surrogateescape') as file:
                 for line in file:    
                     for word in line.split():
                         self.passwords.append(word)
@@ -196,22 +876,38 @@ class RuleGenerator:
         except:
             print("Error opening file", file=sys.stderr)
             exit(1)
+        self.count('passwords', len(self.passwords))
+
+        #DBSCAN and MDBSCAN cluster the whole wordlist at once and save rules like external clustering
+        if (self.DBSCAN or self.MDBSCAN):
+            self.select_clustering()
+            return
+
+        #sparse HAC clusters the whole wordlist at once, no distance matrix is needed
+        if (self.hac_sparse):
+            self.select_clustering()
 
         #compute or load distance matrix
-        if (self.dm_precomputed):
+        elif (self.dm_precomputed):
             try:
-                #loading precomputed distance matrix
+                #precomputed distance matrix of whole wordlist is memory-mapped, blocks of chunks are read when clustered
                 filename_without_extension, _ = os.path.splitext(self.wordlist)
-                self.distance_matrix = np.load(filename_without_extension+'_distance_matrix.npy')
-                number_of_chunks = self.chunking()
-            except:
+                self.precomputed_distance_matrix = np.load(filename_without_extension+'_distance_matrix.npy', mmap_mode='r')
+            except (OSError, ValueError):
                 print("Missing distance matrix", file=sys.stderr)
                 exit(1)
-            self.select_clustering() #after successfully loading distance matrix, cluster passwords
+            if self.precomputed_distance_matrix.shape != (len(self.passwords), len(self.passwords)):
+                print(f"Distance matrix of shape {self.precomputed_distance_matrix.shape} does not match {len(self.passwords)} passwords of wordlist", file=sys.stderr)
+                exit(1)
+            number_of_chunks = self.chunking() #compute number of chunks
+            self.chunks_edit_distance(number_of_chunks) #cluster each chunk with its block of precomputed matrix
         else:
             number_of_chunks = self.chunking() #compute number of chunks
             self.chunks_edit_distance(number_of_chunks) #compute edit distance for each chunk of passwords
 
+        #save rules of all chunks to .rule output file
+        self.save_rules()
+
     #load rule priority from file, if file not present set default
     def create_priority_dict_with_functions(self):
         try:
@@ -240,8 +936,11 @@ class RuleGenerator:
                 "r",
                 "sXY"
             ]
- 
-            
+        self.set_rule_priority(rules)
+
+    #rule priority from rules in order of priority, rule search is compiled for it
+    def set_rule_priority(self, rules):
+        self.rules_priority = {}
         priority = 1
         for rule in rules:
             rule_name = rule.strip() 
@@ -251,29 +950,90 @@ class RuleGenerator:
             else:
                 print(f"Warning: No lambda function defined for rule '{rule_name}'")       
 
+        self.compile_rule_search()
+
                 
     #compute number of chunks and create chunks for passwords for clustering
+    @profiled_stage('chunking')
     def chunking(self):
         number_of_chunks = len(self.passwords) / self.chunk_size
         #separating passwords into chunks
         for x in range(0, len(self.passwords), self.chunk_size):
             chunk = self.passwords[x:x + self.chunk_size]
             self.chunks.append(chunk)
+        self.count('chunks', len(self.chunks))
 
         return number_of_chunks
 
     #compute edit distance for each chunk
     def chunks_edit_distance(self, number_of_chunks):
+        if (self.chunk_jobs > 1 and number_of_chunks > 1):
+            self.chunks_edit_distance_parallel(number_of_chunks)
+            return
         while self.chunk_index < number_of_chunks:
-            self.levenstein_distance_symspell()
+            self.chunk_edit_distance()
             self.chunk_index += 1
 
+    #compute edit distance matrix of current chunk with selected engine, chunk is clustered afterwards
+    def chunk_edit_distance(self):
+        if (self.precomputed_distance_matrix is not None):
+            self.precomputed_distance_chunk()
+        elif (self.distance_pruning):
+            self.levenstein_distance_pruned()
+        elif (self.distance_engine == 'batched'):
+            self.levenstein_distance_batched()
+        else:
+            self.levenstein_distance_symspell()
+
+    #at most chunk_jobs chunks are processed at once, each in a fresh process holding only its own distance matrix
+    #rule counters of chunks are merged in chunk order, so rule ranking is the same as with one chunk at a time
+    def chunks_edit_distance_parallel(self, number_of_chunks):
+        global _rule_generator
+        processes = min(self.chunk_jobs, len(self.chunks))
+        self.import_clustering_modules()
+        #processes are forked during the whole run, one for each chunk
+        previous, _rule_generator = _rule_generator, self
+        try:
+            with multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=1) as pool:
+                for chunk_rules, chunk_cluster_passes, (hits, misses, steps, profile) in pool.imap(_chunk_rule_counter, range(len(self.chunks))):
+                    with self.stage('counting'):
+                        if self.distance_thresholds:
+                            for threshold, threshold_rules in chunk_rules.items():
+                                self.sweep_rules[threshold].update(threshold_rules)
+                                self.sweep_cluster_passes[threshold].extend(chunk_cluster_passes[threshold])
+                                if (self.sweep_most_frequent[threshold] == None):
+                                    self.sweep_most_frequent[threshold] = sum(self.sweep_rules[threshold].values())
+                        else:
+                            self.rules.update(chunk_rules)
+                            self.cluster_passes.extend(chunk_cluster_passes)
+                            if (self.most_frequent == None):
+                                self.most_frequent = sum(self.rules.values())
+                    self.rule_cache_hits += hits
+                    self.rule_cache_misses += misses
+                    self.rule_search_steps += steps
+                    if profile is not None:
+                        self.profile.merge(profile)
+        finally:
+            _rule_generator = previous
+        self.chunk_index = len(self.chunks)
+
+    #distance matrix of current chunk is its diagonal block of precomputed matrix of whole wordlist
+    @profiled_stage('distance_matrix')
+    def precomputed_distance_chunk(self):
+        start = self.chunk_index * self.chunk_size
+        end = start + len(self.chunks[self.chunk_index])
+        self.distance_matrix = np.array(self.precomputed_distance_matrix[start:end, start:end])
+        self.select_clustering()
+
     #computing edit distance matrix - for clustering methods AP and HAC
+    @profiled_stage('distance_matrix')
     def levenstein_distance_symspell(self):
 
         total_passwords = len(self.chunks[self.chunk_index])
+        edit_distance_calculator = self.symspell_edit_distance()
         # Initialize the distance matrix with zeros
         self.distance_matrix = np.zeros((total_passwords, total_passwords),dtype=np.int8)
+        self.count('distance_pairs', total_passwords * (total_passwords - 1) // 2)
         for i, password_col in enumerate(self.chunks[self.chunk_index]):
             for j in range(i, len(self.chunks[self.chunk_index])):  # Start loop from i to avoid recalculating distances
                 if i == j:
@@ -281,45 +1041,451 @@ class RuleGenerator:
                     self.distance_matrix[i][j] = 0
                 else:
                     # Calculate distance only once for each pair
-                    distance = self.edit_distance_calculator.compare(password_col, self.chunks[self.chunk_index][j], max_distance=100)
+                    distance = edit_distance_calculator.compare(password_col, self.chunks[self.chunk_index][j], max_distance=100)
                     # Since the matrix is symmetrical, we can mirror the value across the diagonal
                     self.distance_matrix[i][j] = distance
                     self.distance_matrix[j][i] = distance
         self.select_clustering()
 
+    #symspell edit distance calculator, created on first use
+    def symspell_edit_distance(self):
+        if self.edit_distance_calculator is None:
+            from symspellpy.editdistance import EditDistance, DistanceAlgorithm
+            self.edit_distance_calculator = EditDistance(DistanceAlgorithm.LEVENSHTEIN_FAST)
+        return self.edit_distance_calculator
+
+    #computing edit distance matrix by blocks of rows - for clustering methods AP and HAC
+    #each block is computed with rapidfuzz on all cores and written straight into the int8 matrix
+    @profiled_stage('distance_matrix')
+    def levenstein_distance_batched(self):
+        chunk = self.chunks[self.chunk_index]
+        total_passwords = len(chunk)
+        self.distance_matrix = np.zeros((total_passwords, total_passwords), dtype=np.int8)
+        for start in range(0, total_passwords, self.distance_block_size):
+            end = min(start + self.distance_block_size, total_passwords)
+            #only the upper triangle is computed, distance to itself stays 0
+            block = self.edit_distance_block(chunk[start:end], chunk[start:])
+            self.distance_matrix[start:end, start:] = block
+            self.distance_matrix[start:, start:end] = block.T
+        self.select_clustering()
+
+    #computing edit distance matrix only for pairs that can be closer than distance_threshold - for HAC clustering
+    #passwords are sorted by length, pairs with larger length difference are skipped and the other distances
+    #are capped at distance_threshold, so every distance at or above the threshold is stored as the threshold itself
+    #the matrix stays in length order, labels are mapped back to chunk order in process_model_data
+    @profiled_stage('distance_matrix')
+    def levenstein_distance_pruned(self):
+        chunk = self.chunks[self.chunk_index]
+        total_passwords = len(chunk)
+        far = self.distance_threshold
+        self.distance_matrix = np.full((total_passwords, total_passwords), far, dtype=np.int8)
+
+        lengths = np.array([len(password) for password in chunk])
+        order = np.argsort(lengths, kind='stable')
+        lengths = lengths[order]
+        sorted_chunk = [chunk[i] for i in order]
+        for start in range(0, total_passwords, self.distance_block_size):
+            end = min(start + self.distance_block_size, total_passwords)
+            #passwords longer by threshold or more than the longest password of the block cannot be close enough
+            stop = np.searchsorted(lengths, lengths[end - 1] + far, side='left')
+            #bit-parallel full distance is cheaper than the bounded one for short strings, it is saturated afterwards
+            block = cdist(sorted_chunk[start:end], sorted_chunk[start:stop], scorer=RapidfuzzLevenshtein.distance, score_cutoff=100, dtype=np.int8, workers=self.distance_workers)
+            self.count('distance_pairs', block.size)
+            np.minimum(block, far, out=block)
+            self.distance_matrix[start:end, start:stop] = block
+            self.distance_matrix[start:stop, start:end] = block.T
+
+        self.distance_matrix_order = order
+        self.select_clustering()
+
+    #exact edit distances between two lists of passwords, distances above 100 are stored as -1 like symspell compare does
+    def edit_distance_block(self, rows, columns):
+        block = cdist(rows, columns, scorer=RapidfuzzLevenshtein.distance, score_cutoff=100, dtype=np.int8, workers=self.distance_workers)
+        self.count('distance_pairs', block.size)
+        block[block > 100] = -1
+        return block
+
 
 
     #choose clustering method
     def select_clustering(self):
-        if (self.HAC):
+        if (self.HAC and self.hac_sparse):
+            self.HAC_sparse_clustering()
+        elif (self.HAC):
             self.HAC_clustering()
         elif (self.AP):
             self.AP_clustering()
+        elif (self.DBSCAN or self.MDBSCAN):
+            self.DBSCAN_clustering()
         elif (self.STDIN):
             self.external_clustering()
              
 
     #clustering with various methods
+    @profiled_stage('clustering')
     def HAC_clustering(self):
+        if (self.distance_thresholds):
+            self.HAC_sweep_clustering()
+            return
+        from sklearn.cluster import AgglomerativeClustering
         self.model = AgglomerativeClustering(n_clusters=None, metric='precomputed',linkage='single', distance_threshold=self.distance_threshold)
         self.clusters = self.process_model_data()
         self.compute_cluster_representative()
         self.get_rules_from_cluster()
 
+    #single linkage HAC at every threshold of sweep from one minimum spanning tree of chunk
+    #clusters below threshold are components of tree edges shorter than it, same as AgglomerativeClustering gives
+    def HAC_sweep_clustering(self):
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        parents, weights = self.minimum_spanning_tree()
+        vertices = np.arange(len(parents))
+        for threshold in self.distance_thresholds:
+            edges = weights < threshold
+            tree = coo_matrix((np.ones(np.count_nonzero(edges), dtype=np.int8), (vertices[edges], parents[edges])), shape=(len(parents), len(parents)))
+            #components are numbered from the lowest vertex, that is in order of first members
+            _, cluster_labels = connected_components(tree, directed=False)
+            self.clusters = self.clusters_from_labels(cluster_labels)
+            self.compute_cluster_representative()
+
+            self.rules, self.most_frequent = self.sweep_rules[threshold], self.sweep_most_frequent[threshold]
+            self.cluster_passes = self.sweep_cluster_passes[threshold]
+            self.get_rules_from_cluster()
+            self.sweep_most_frequent[threshold] = self.most_frequent
+
+    #Prim's minimum spanning tree of distance matrix, every row but the first is joined to its parent by edge of given weight
+    #first row has no edge, its weight is above every threshold
+    def minimum_spanning_tree(self):
+        size = len(self.distance_matrix)
+        parents = np.zeros(size, dtype=np.int64)
+        weights = np.empty(size, dtype=np.int16)
+        outside = np.iinfo(np.int16).max
+        in_tree = np.zeros(size, dtype=bool)
+        distances = np.asarray(self.distance_matrix[0], dtype=np.int16).copy()
+        in_tree[0] = True
+        distances[0] = weights[0] = outside
+        for _ in range(size - 1):
+            row = int(np.argmin(distances))
+            weights[row] = distances[row]
+            in_tree[row] = True
+            distances[row] = outside
+            row_distances = self.distance_matrix[row]
+            closer = (row_distances < distances) & ~in_tree
+            distances[closer] = row_distances[closer]
+            parents[closer] = row
+        return parents, weights
+
+    #single linkage HAC on sparse graph - clusters are connected components of graph with edges between passwords
+    #closer than distance_threshold, neighbours are looked up with symspell and joined with union-find
+    @profiled_stage('clustering')
+    def HAC_sparse_clustering(self):
+        self.clusters = {}
+        if self.distance_threshold < 1:
+            #nothing is closer than threshold, every password is its own cluster
+            self.clusters = {label: [password] for label, password in enumerate(self.passwords)}
+        else:
+            max_distance = self.distance_threshold - 1
+            unique_passwords = list(dict.fromkeys(self.passwords))
+            password_index = {password: i for i, password in enumerate(unique_passwords)}
+            parents = list(range(len(unique_passwords)))
+
+            def find(i):
+                while parents[i] != i:
+                    parents[i] = parents[parents[i]]
+                    i = parents[i]
+                return i
+
+            neighbourhoods = self.cached_neighbourhoods(unique_passwords, max_distance)
+            for i, password in enumerate(unique_passwords):
+                for j in neighbourhoods[i]:
+                    #symspell measures Damerau-OSA distance, edge needs Levenshtein distance below threshold
+                    if j > i and lev.distance(password, unique_passwords[j], score_cutoff=max_distance) <= max_distance:
+                        root_i, root_j = find(i), find(j)
+                        if root_i != root_j:
+                            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+            #labels are numbered in order of first occurrence in wordlist
+            root_labels = {}
+            for password in self.passwords:
+                root = find(password_index[password])
+                if root not in root_labels:
+                    root_labels[root] = len(root_labels)
+                    self.clusters[root_labels[root]] = []
+                self.clusters[root_labels[root]].append(password)
+
+        for label, passwords_in_cluster in self.clusters.items():
+            self.cluster_representatives[label] = passwords_in_cluster[self.cluster_medoid(passwords_in_cluster)]
+        self.get_rules_from_cluster()
+
+    #DBSCAN and MDBSCAN clustering of whole wordlist, same algorithm as MDBSCAN/MDBSCAN/Program.cs
+    #eps1 neighbourhoods are symspell lookups, clusters are expanded from core passwords with a stack,
+    #MDBSCAN additionally admits only passwords within Jaro-Winkler distance eps2 from the initial password of cluster
+    @profiled_stage('clustering')
+    def DBSCAN_clustering(self):
+        words = list(dict.fromkeys(self.passwords))
+        eps1 = self.eps if self.DBSCAN else self.eps1
+        neighbourhoods = self.cached_neighbourhoods(words, eps1)
+
+        word_labels = [-1] * len(words)
+        cluster_index = 0
+        search_stack = []
+        for initial_entry in range(len(words)):
+            if word_labels[initial_entry] != -1 or neighbourhoods.size(initial_entry) < self.min_points:
+                continue
+
+            search_stack.append(initial_entry)
+            while search_stack:
+                current = search_stack.pop()
+                if word_labels[current] != -1:
+                    continue
+                if self.MDBSCAN and not self.jaro_winkler_distance(words[initial_entry], words[current]) < self.eps2:
+                    continue
+                word_labels[current] = cluster_index
+                if neighbourhoods.size(current) >= self.min_points:
+                    search_stack.extend(x for x in neighbourhoods[current] if word_labels[x] == -1)
+
+            cluster_index += 1
+
+        #same structure as JSON output of MDBSCAN, outliers first
+        members = {label: [] for label in range(-1, cluster_index)}
+        for word, label in zip(words, word_labels):
+            members[label].append(word)
+        if not members[-1]:
+            del members[-1]
+
+        data = {}
+        for label, passwords_in_cluster in members.items():
+            data[str(label)] = {'Item1': passwords_in_cluster, 'Item2': passwords_in_cluster[self.cluster_medoid(passwords_in_cluster)]}
+        self.rules_from_external_clusters(data)
+
+    #eps neighbourhoods of words, memory-mapped from binary cache next to wordlist when it was computed before
+    #JSON cache written by MDBSCAN is converted, otherwise neighbourhoods are computed and cached
+    @profiled_stage('neighbourhoods')
+    def cached_neighbourhoods(self, words, eps):
+        if not self.neighbourhood_cache or self.wordlist is None:
+            return self.symspell_neighbourhoods(words, eps)
+
+        directory, name = os.path.split(os.path.abspath(self.wordlist))
+        cache_name = os.path.join(directory, f'.MDBSCANcache.{eps}.{name}')
+        wordlist_hash = self.wordlist_digest()
+
+        neighbourhoods = Neighbourhoods.load(cache_name + '.bin', eps, wordlist_hash)
+        if neighbourhoods is not None and len(neighbourhoods) == len(words):
+            return neighbourhoods
+
+        neighbourhoods = Neighbourhoods.from_mdbscan_json(cache_name + '.json', words)
+        if neighbourhoods is None:
+            neighbourhoods = self.symspell_neighbourhoods(words, eps)
+        try:
+            neighbourhoods.save(cache_name + '.bin', words, eps, wordlist_hash)
+        except OSError:
+            print("Warning: Cannot write neighbourhood cache", file=sys.stderr)
+        return neighbourhoods
+
+    #eps neighbourhood of every word as word indices, word itself included
+    #symspell lookups (Damerau-OSA distance) are spread over all cores
+    def symspell_neighbourhoods(self, words, max_distance):
+        global _neighbourhood_lookup
+        self.count('neighbourhood_lookups', len(words))
+        from symspellpy import SymSpell
+        sym_spell = SymSpell(max_dictionary_edit_distance=max_distance, prefix_length=max(7, max_distance + 1))
+        for word in words:
+            sym_spell.create_dictionary_entry(word, 1)
+        _neighbourhood_lookup = (sym_spell, words, {word: i for i, word in enumerate(words)}, max_distance)
+
+        processes = os.cpu_count() or 1
+        batch = 2000
+        bounds = [(start, min(start + batch, len(words))) for start in range(0, len(words), batch)]
+        try:
+            if processes > 1 and len(bounds) > 1:
+                with multiprocessing.get_context('fork').Pool(processes) as pool:
+                    batches = pool.map(_lookup_neighbourhoods, bounds)
+            else:
+                batches = [_lookup_neighbourhoods(bound) for bound in bounds]
+        finally:
+            _neighbourhood_lookup = None
+        if not batches:
+            return Neighbourhoods.from_sizes(np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32))
+        return Neighbourhoods.from_sizes(np.concatenate([sizes for sizes, _ in batches]), np.concatenate([indices for _, indices in batches]))
+
+    #Jaro-Winkler distance as computed by F23.StringSimilarity used in MDBSCAN/MDBSCAN/JaroWinkler.cs
+    #(Jaro similarity in single precision, prefix is not limited to 4 characters)
+    def jaro_winkler_distance(self, s1, s2):
+        if s1 == s2:
+            return 0.0
+        if len(s1) > len(s2):
+            longer, shorter = s1, s2
+        else:
+            longer, shorter = s2, s1
+        search_range = max(len(longer) // 2 - 1, 0)
+        match_flags = [False] * len(longer)
+        shorter_matches = []
+        for i, char in enumerate(shorter):
+            for j in range(max(i - search_range, 0), min(i + search_range + 1, len(longer))):
+                if not match_flags[j] and char == longer[j]:
+                    match_flags[j] = True
+                    shorter_matches.append(char)
+                    break
+        matches = len(shorter_matches)
+        if matches == 0:
+            return 1.0
+        longer_matches = [char for char, flag in zip(longer, match_flags) if flag]
+        transpositions = sum(a != b for a, b in zip(shorter_matches, longer_matches)) // 2
+        prefix = 0
+        for a, b in zip(shorter, longer):
+            if a != b:
+                break
+            prefix += 1
+
+        m = np.float32(matches)
+        jaro = float((m / np.float32(len(s1)) + m / np.float32(len(s2)) + (m - np.float32(transpositions)) / m) / np.float32(3))
+        if jaro > 0.7:
+            jaro = jaro + min(0.1, 1.0 / len(longer)) * prefix * (1 - jaro)
+        return 1.0 - jaro
+
+    @profiled_stage('clustering')
     def AP_clustering(self):            
-        self.distance_matrix = -1 * self.distance_matrix.astype(np.float16)
-        self.model = AffinityPropagation(affinity="precomputed", damping=self.dampning, convergence_iter=self.convergence_iter)
-        self.model.fit(self.distance_matrix)
+        if (self.ap_engine == 'lean'):
+            #int8 distances are used as they are, model is fitted once in process_model_data
+            self.model = LeanAffinityPropagation(damping=self.dampning, convergence_iter=self.convergence_iter, block_size=self.distance_block_size)
+        else:
+            self.distance_matrix = -1 * self.distance_matrix.astype(np.float16)
+            from sklearn.cluster import AffinityPropagation
+            self.model = AffinityPropagation(affinity="precomputed", damping=self.dampning, convergence_iter=self.convergence_iter)
+            self.model.fit(self.distance_matrix)
         self.clusters = self.process_model_data()
         self.compute_cluster_representative_AP()
         self.get_rules_from_cluster()
 
     #DBSCAN and MDBSCAN
     def external_clustering(self):
-        data = json.load(sys.stdin)
+        if (self.stream):
+            self.streamed_external_clustering()
+            return
+        with self.stage('load'):
+            data = json.load(sys.stdin)
+        self.rules_from_external_clusters(data)
+
+    #DBSCAN and MDBSCAN, clusters are parsed from stdin one at a time and dropped after their rules are generated
+    #every representative method pass counts its rules separately, counters are merged in the order of passes
+    #so the ranking is the same as with whole document loaded
+    @profiled_stage('rule_generation')
+    def streamed_external_clustering(self):
+        classic = lambda label, cluster: self.rules_from_cluster_classic(label, cluster['Item1'], cluster['Item2'])
+        substr = lambda label, cluster: self.rules_from_cluster_substr(label, cluster['Item1'])
+        passes = {"levenshtein": [classic], "combo": [classic, substr], "substring": [substr]}[self.representative]
+        pass_counters = [self.rule_counter() for _ in passes]
+
+        if (self.jobs > 1):
+            self.streamed_external_clustering_parallel(pass_counters)
+        else:
+            for label, cluster in self.iter_json_object(sys.stdin):
+                self.count('clusters')
+                for rules_from_cluster, counter in zip(passes, pass_counters):
+                    rules = rules_from_cluster(label, cluster)
+                    with self.stage('counting'):
+                        counter.update(rules)
+
+        counter = pass_counters[0]
+        with self.stage('counting'):
+            for pass_counter in pass_counters[1:]:
+                counter.update(pass_counter)
+        self.save_frequent_rules_to_file(counter)
+
+    #clusters are read in windows of about chunk_size passwords per process, rules of each window are generated in parallel
+    def streamed_external_clustering_parallel(self, pass_counters):
+        methods = {"levenshtein": ["levenshtein"], "combo": ["levenshtein", "substring"], "substring": ["substring"]}[self.representative]
+        window_size = self.chunk_size * self.jobs
+        with self.rule_pool() as pool:
+            window = []
+            window_passwords = 0
+            for label, cluster in chain(self.iter_json_object(sys.stdin), [(None, None)]):
+                if cluster is not None:
+                    self.count('clusters')
+                    window.append((label, cluster['Item1'], cluster['Item2']))
+                    window_passwords += len(cluster['Item1'])
+                    if window_passwords < window_size:
+                        continue
+                items = [(method, label, passwords_in_cluster, representative) for method in methods for label, passwords_in_cluster, representative in window]
+                counters = self.cluster_rule_counters(items, pool)
+                with self.stage('counting'):
+                    for pass_index, counter in enumerate(pass_counters):
+                        for cluster_counter in counters[pass_index * len(window):(pass_index + 1) * len(window)]:
+                            counter.update(cluster_counter)
+                window = []
+                window_passwords = 0
+
+    #yield (key, value) pairs of top-level JSON object one at a time, only the value being parsed is held in memory
+    def iter_json_object(self, file, read_size=1 << 16):
+        decoder = json.JSONDecoder()
+        buffer = ''
+        position = 0
+        end_of_file = False
+        expected = '{'
+        key = None
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\n\r':
+                position += 1
+            if position == len(buffer):
+                if end_of_file:
+                    raise ValueError("Unexpected end of clustering JSON")
+                data = file.read(read_size)
+                end_of_file = not data
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+
+            char = buffer[position]
+            if char == '}' and expected in ('key', ','):
+                return
+            if expected in ('{', ':', ','):
+                if char != expected:
+                    raise ValueError(f"Expected '{expected}' in clustering JSON")
+                position += 1
+                expected = 'value' if expected == ':' else 'key'
+                continue
+
+            #decode key or value, read more input while it is incomplete
+            try:
+                decoded, end = decoder.raw_decode(buffer, position)
+                complete = end < len(buffer) or end_of_file
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+                complete = False
+            if not complete:
+                data = file.read(max(read_size, len(buffer) - position))
+                end_of_file = not data
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+
+            position = end
+            if expected == 'key':
+                key = decoded
+                expected = ':'
+            else:
+                yield key, decoded
+                expected = ','
+
+    #generate rules from clusters in MDBSCAN output format {label: {"Item1": members, "Item2": representative}}
+    def rules_from_external_clusters(self, data):
         self.clusters = {key:value['Item1'] for (key,value) in data.items()}
         self.cluster_representatives = {key:value['Item2'] for (key,value) in data.items()}
-        if (self.representative == "levenshtein"):
+        self.get_rules_from_external_clusters()
+
+        #save rules to .rule output file
+        self.save_frequent_rules_to_file()
+
+    #rules of clusters of whole wordlist, every representative method goes over all clusters
+    @profiled_stage('rule_generation')
+    def get_rules_from_external_clusters(self):
+        self.count('clusters', len(self.clusters))
+        self.keep_cluster_pass('external')
+        if (self.jobs > 1):
+            methods = {"levenshtein": ["levenshtein"], "combo": ["levenshtein", "substring"], "substring": ["substring"]}[self.representative]
+            self.get_rules_from_cluster_parallel(methods)
+        elif (self.representative == "levenshtein"):
             self.get_rules_from_cluster_classic()
         elif (self.representative == "combo"):          
             self.get_rules_from_cluster_classic()
@@ -328,48 +1494,89 @@ class RuleGenerator:
         elif (self.representative == "substring"):
             self.get_rules_from_cluster_substr()
 
-
-        #save rules to .rule output file
         if (self.most_frequent == None):
-            self.most_frequent = len(self.rules)
- 
-        self.save_frequent_rules_to_file()
-        
-        
+            self.most_frequent = sum(self.rules.values())
+
+    #keep clusters of rule generation pass for clusters file
+    def keep_cluster_pass(self, order):
+        if self.clusters_file is None:
+            return
+        self.cluster_order = order
+        #numpy labels are stored as ints, labels of external clusters stay strings
+        self.cluster_passes.append([[label.item() if isinstance(label, np.generic) else label, self.cluster_representatives.get(label), passwords_in_cluster] for label, passwords_in_cluster in self.clusters.items()])
+
+    #generate rules from clusters file, passes are repeated in their order with current rule priority
+    #so rules are the same as in the run that saved them, no distances are computed
+    def rules_from_saved_clusters(self, document):
+        for cluster_pass in document['passes']:
+            self.clusters = {label: passwords_in_cluster for label, _, passwords_in_cluster in cluster_pass}
+            self.cluster_representatives = {label: representative for label, representative, _ in cluster_pass}
+            if document['order'] == 'external':
+                self.get_rules_from_external_clusters()
+            else:
+                self.get_rules_from_cluster()
 
     #computes clusters based on model model, creates dictionary according to cluster label
+    #chunk indices of members of each cluster are kept in cluster_indices, clusters are ordered by their first member
     def process_model_data(self):
-        cluster_labels = self.model.fit_predict(self.distance_matrix)
-        clusters = {}
-        for index, label in enumerate(cluster_labels):
-            if label not in clusters:
-                clusters[label] = [self.chunks[self.chunk_index][index]]
-            else:
-                clusters[label].append(self.chunks[self.chunk_index][index])
-        return clusters       
+        return self.clusters_from_labels(self.model.fit_predict(self.distance_matrix))
+
+    #clusters of chunk passwords from labels of distance matrix rows, in order of their first members
+    def clusters_from_labels(self, cluster_labels):
+        if self.distance_matrix_order is not None:
+            #matrix rows are permuted, return labels to chunk order
+            chunk_labels = np.empty_like(cluster_labels)
+            chunk_labels[self.distance_matrix_order] = cluster_labels
+            cluster_labels = chunk_labels
+
+        members = np.argsort(cluster_labels, kind='stable')
+        groups = np.split(members, np.flatnonzero(np.diff(cluster_labels[members])) + 1)
+        groups.sort(key=lambda indices: indices[0])
+
+        chunk = self.chunks[self.chunk_index]
+        self.cluster_indices = {cluster_labels[indices[0]]: indices for indices in groups if len(indices)}
+        return {label: [chunk[index] for index in indices] for label, indices in self.cluster_indices.items()}
     
     #computation of cluster representative
+    @profiled_stage('representatives')
     def compute_cluster_representative(self):
         for label, passwords_in_cluster in self.clusters.items():
-            cluster_indices = []
-            
-            #get indices of passwords in passwords array
-            for password in passwords_in_cluster:
-                index = self.chunks[self.chunk_index].index(password)
-                cluster_indices.append(index)
-            
-            #get part of distance matrix according to indices 
-            cluster_distance_matrix = self.distance_matrix[cluster_indices, :][:, cluster_indices]
-            
-            #calculate edit distance mean of passwords in cluster
-            edit_distance_mean = np.mean(cluster_distance_matrix, axis=0)
-            closest_index = np.argmin(edit_distance_mean)
+            if (self.distance_pruning):
+                #pruned matrix holds only saturated distances, representative needs the exact ones
+                self.cluster_representatives[label] = passwords_in_cluster[self.cluster_medoid(passwords_in_cluster)]
+                continue
+
+            #password with the lowest edit distance mean to passwords in cluster
+            closest_index = self.matrix_medoid(self.cluster_indices[label])
             self.cluster_representatives[label] = passwords_in_cluster[closest_index]
 
+    #position of medoid among given rows of distance matrix, with the lowest distance sum to the other rows
+    #sums are reduced by blocks of rows, so no copy of whole cluster matrix is made
+    def matrix_medoid(self, indices):
+        distance_sums = np.empty(len(indices), dtype=np.int64)
+        for start in range(0, len(indices), self.distance_block_size):
+            end = min(start + self.distance_block_size, len(indices))
+            distance_sums[start:end] = self.distance_matrix[indices[start:end]][:, indices].sum(axis=1, dtype=np.int64)
+        return int(np.argmin(distance_sums))
+
+    #index of password with the lowest mean edit distance to other passwords in cluster, without distance matrix
+    #distances are summed by blocks of rows, so large clusters never hold the whole cluster matrix
+    #distances are not clipped to int8 here, -1 for distance above 100 would pull the medoid towards far passwords
+    @profiled_stage('representatives')
+    def cluster_medoid(self, passwords_in_cluster):
+        distance_sums = np.empty(len(passwords_in_cluster), dtype=np.int64)
+        for start in range(0, len(passwords_in_cluster), self.distance_block_size):
+            end = min(start + self.distance_block_size, len(passwords_in_cluster))
+            block = cdist(passwords_in_cluster[start:end], passwords_in_cluster, scorer=RapidfuzzLevenshtein.distance, dtype=np.int32, workers=self.distance_workers)
+            self.count('distance_pairs', block.size)
+            distance_sums[start:end] = block.sum(axis=1, dtype=np.int64)
+        return int(np.argmin(distance_sums))
+
     #get a same format of cluster representative with ap
+    @profiled_stage('representatives')
     def compute_cluster_representative_AP(self):
         for label in np.unique(self.model.labels_):
-            exemplar = self.passwords[self.model.cluster_centers_indices_[label]]
+            exemplar = self.chunks[self.chunk_index][self.model.cluster_centers_indices_[label]]
             self.cluster_representatives[label] = exemplar
     
     #computation of cluster representative
@@ -380,13 +1587,20 @@ class RuleGenerator:
             for entry in cluster:
                 distances = []
                 for other in cluster:
-                    distances.append(self.edit_distance_calculator.compare(entry,other,max_distance=100))
+                    distances.append(self.symspell_edit_distance().compare(entry,other,max_distance=100))
                 average_distances.append(sum(distances) / len(distances))
             representative, _ = min(enumerate(average_distances), key=itemgetter(1))
             self.cluster_representatives[label] = cluster[representative]
 
+    @profiled_stage('rule_generation')
     def get_rules_from_cluster(self):
-        if (self.representative == "substring"):
+        self.count('clusters', len(self.clusters))
+        self.keep_cluster_pass('chunks')
+        if (self.jobs > 1):
+            methods = {"levenshtein": ["levenshtein"], "combo": ["substring", "levenshtein"], "substring": ["substring"]}[self.representative]
+            self.get_rules_from_cluster_parallel(methods)
+
+        elif (self.representative == "substring"):
             self.get_rules_from_cluster_substr()
             
 
@@ -397,11 +1611,9 @@ class RuleGenerator:
             self.get_rules_from_cluster_substr()
             self.get_rules_from_cluster_classic()
 
-        #save rules to .rule output file
+        #number of rules of the first clustered chunk
         if (self.most_frequent == None):
-            self.most_frequent = len(self.rules)
- 
-        self.save_frequent_rules_to_file()
+            self.most_frequent = sum(self.rules.values())
 
     def remove_leetspeak(self,password):
         return ''.join(self.leet_to_alpha.get(char, char) for char in password)
@@ -411,93 +1623,411 @@ class RuleGenerator:
     #SUBSTRING method: the "representative" is the longest common substring
     def get_rules_from_cluster_substr(self):
         for label, passwords_in_cluster in self.clusters.items():
-            if self.remove_outliers and label == '-1' and self.STDIN:
-                continue
-
-            
-            passwords_in_cluster_lower = []
-            for i in range(len(passwords_in_cluster)):
-                password = passwords_in_cluster[i].lower()
-                password = self.remove_leetspeak(password)
-                passwords_in_cluster_lower.append(password)
-
-            representative = self.find_longest_common_substring(passwords_in_cluster_lower)
-            
-            if (self.verbose):
-                print(f"Cluster {label} (Representative: {representative}): {', '.join(passwords_in_cluster)}")
-            
-
-            if (representative == ""):
-                continue
-            
-            cluster_rules = [] 
-            cluster_rules_set = set()
-            #generate rules from one password from cluster
-            for password in passwords_in_cluster:
-                word_rules = self.generate_hashcat_rules(representative, password) #rules from one password
-                #add newly generated rules to rules that belong to this one cluster
-                new_rules = set(word_rules) - cluster_rules_set
-                cluster_rules.extend(new_rules)
-                cluster_rules_set.update(new_rules)
-                cluster_rules.extend(word_rules)
-                
-            #add newly generated rules from cluster to final ruleset
-            self.rules.extend(cluster_rules)
-            if (self.verbose):
-                print(word_rules)
+            rules = self.rules_from_cluster_substr(label, passwords_in_cluster)
+            with self.stage('counting'):
+                self.rules.update(rules)
 
     #get rules from each cluster, optionally dont generate rules from outlier clusters
     def get_rules_from_cluster_classic(self):
         for label, passwords_in_cluster in self.clusters.items():
-            if self.remove_outliers and label == -1:
-                continue
-            representative = self.cluster_representatives[label] #get representative of given cluster
-            if (self.verbose):
-                print(f"Cluster {label} (Representative: {representative}): {', '.join(passwords_in_cluster)}")
-            cluster_rules = []
-            cluster_rules_set = set()
-            #generate rules from one password from cluster
-            for password in passwords_in_cluster:                    
-                word_rules = self.generate_hashcat_rules(representative, password)  #rules from one password
-                #add newly generated rules to rules that belong to this one cluster
-                new_rules = set(word_rules) - cluster_rules_set
-                cluster_rules.extend(new_rules)
-                cluster_rules_set.update(new_rules)
-                cluster_rules.extend(word_rules)
-                
-            #add newly generated rules from cluster to final ruleset
-            self.rules.extend(cluster_rules)
+            rules = self.rules_from_cluster_classic(label, passwords_in_cluster, self.cluster_representatives[label])
+            with self.stage('counting'):
+                self.rules.update(rules)
+
+    #get rules from each cluster with every representative method in worker processes
+    #per-cluster counters are merged in the serial order, so rule ranking is the same as with one process
+    def get_rules_from_cluster_parallel(self, methods):
+        items = [(method, label, passwords_in_cluster, self.cluster_representatives.get(label)) for method in methods for label, passwords_in_cluster in self.clusters.items()]
+        with self.rule_pool() as pool:
+            counters = self.cluster_rule_counters(items, pool)
+        with self.stage('counting'):
+            for counter in counters:
+                self.rules.update(counter)
+
+    #pool of forked processes sharing this generator and its rule priority
+    def rule_pool(self):
+        global _rule_generator
+        #generator of batch worker stays shared, the worker needs it for its next wordlists
+        previous, _rule_generator = _rule_generator, self
+        try:
+            return multiprocessing.get_context('fork').Pool(self.jobs)
+        finally:
+            _rule_generator = previous
+
+    #rule counters of clusters given as (method, label, passwords in cluster, representative), in order of items
+    #largest clusters are scheduled first, small clusters are batched to keep every process busy
+    def cluster_rule_counters(self, items, pool):
+        order = sorted(range(len(items)), key=lambda index: len(items[index][2]), reverse=True)
+        batch_size = max(1, sum(len(item[2]) for item in items) // (self.jobs * 16))
+        batches = []
+        batch = []
+        batch_passwords = 0
+        for index in order:
+            batch.append((index,) + items[index])
+            batch_passwords += len(items[index][2])
+            if batch_passwords >= batch_size:
+                batches.append(batch)
+                batch = []
+                batch_passwords = 0
+        if batch:
+            batches.append(batch)
+
+        counters = [None] * len(items)
+        for batch_counters, hits, misses, steps in pool.imap_unordered(_cluster_rule_counters, batches):
+            for index, counter in batch_counters:
+                counters[index] = counter
+            self.rule_cache_hits += hits
+            self.rule_cache_misses += misses
+            self.rule_search_steps += steps
+        return counters
+
+    #outliers are skipped with --remove_outliers, they are labeled '-1' in clustering JSON and -1 by chunk clustering
+    def is_removed_outlier(self, label):
+        return self.remove_outliers and label in (-1, '-1')
+
+    #rules from one cluster with longest common substring as representative
+    def rules_from_cluster_substr(self, label, passwords_in_cluster):
+        if self.is_removed_outlier(label):
+            return []
+
+        passwords_in_cluster_lower = []
+        for i in range(len(passwords_in_cluster)):
+            password = passwords_in_cluster[i].lower()
+            password = self.remove_leetspeak(password)
+            passwords_in_cluster_lower.append(password)
+
+        representative = self.find_longest_common_substring(passwords_in_cluster_lower)
+        
+        if (self.verbose):
+            print(f"Cluster {label} (Representative: {representative}): {', '.join(passwords_in_cluster)}")
+        
 
-            if (self.verbose):
-                print(word_rules)
-            
+        if (representative == ""):
+            return []
+        
+        return self.rules_from_cluster_passwords(representative, passwords_in_cluster)
+
+    #rules from one cluster with given representative
+    def rules_from_cluster_classic(self, label, passwords_in_cluster, representative):
+        if self.is_removed_outlier(label):
+            return []
+        if (self.verbose):
+            print(f"Cluster {label} (Representative: {representative}): {', '.join(passwords_in_cluster)}")
+
+        return self.rules_from_cluster_passwords(representative, passwords_in_cluster)
+
+    #rules transforming representative to each password from cluster
+    def rules_from_cluster_passwords(self, representative, passwords_in_cluster):
+        cluster_rules = []
+        cluster_rules_set = set()
+        #generate rules from one password from cluster
+        for password in passwords_in_cluster:
+            word_rules = self.generate_hashcat_rules(representative, password) #rules from one password
+            #add newly generated rules to rules that belong to this one cluster
+            new_rules = set(word_rules) - cluster_rules_set
+            cluster_rules.extend(new_rules)
+            cluster_rules_set.update(new_rules)
+            cluster_rules.extend(word_rules)
+
+        if (self.verbose):
+            print(word_rules)
+        return cluster_rules
+
+    #longest substring common to all words, the leftmost one in the first word when there are more of the same length
+    #suffix automaton of the first word, other words are matched against it in time linear in their length
     def find_longest_common_substring(self,words):
         s = words[0]
-        #function to find the longest match
-        def longest_match(s, words):
-            sm = difflib.SequenceMatcher(None, s, words[0])
-            longest = ''
-            for i in range(len(s)):
-                for j in range(i + 1, len(s) + 1):
-                    sub = s[i:j]
-                    if all(sub in word for word in words):
-                        if len(sub) > len(longest):
-                            longest = sub
-            return longest
-    
-    
-        common_substring = longest_match(s, words)
-        return common_substring    
+
+        #states of suffix automaton - transitions, suffix link, length of longest string and its first end position in s
+        transitions = [{}]
+        link = [-1]
+        length = [0]
+        first_end = [-1]
+        last = 0
+        for position, char in enumerate(s):
+            state = len(length)
+            transitions.append({})
+            link.append(0)
+            length.append(length[last] + 1)
+            first_end.append(position)
+            p = last
+            while p != -1 and char not in transitions[p]:
+                transitions[p][char] = state
+                p = link[p]
+            if p != -1:
+                q = transitions[p][char]
+                if length[p] + 1 == length[q]:
+                    link[state] = q
+                else:
+                    clone = len(length)
+                    transitions.append(dict(transitions[q]))
+                    link.append(link[q])
+                    length.append(length[p] + 1)
+                    first_end.append(first_end[q])
+                    while p != -1 and transitions[p].get(char) == q:
+                        transitions[p][char] = clone
+                        p = link[p]
+                    link[q] = clone
+                    link[state] = clone
+            last = state
+
+        #length of longest string of each state common to all words, states with nothing in common are dropped
+        common = {state: length[state] for state in range(1, len(length))}
+        common_substrings = None
+        for word in dict.fromkeys(words[1:]):
+            if word == s:
+                continue
+            #word containing every common string can not shorten them
+            if common_substrings is not None and all(substring in word for substring in common_substrings):
+                continue
+            matched = {}
+            state = 0
+            match_length = 0
+            for char in word:
+                while state and char not in transitions[state]:
+                    state = link[state]
+                    match_length = length[state]
+                if char in transitions[state]:
+                    state = transitions[state][char]
+                    match_length += 1
+                    if match_length > matched.get(state, 0):
+                        matched[state] = match_length
+                        #whole strings of suffix link parents are matched as well
+                        parent = link[state]
+                        while parent > 0 and matched.get(parent, 0) < length[parent]:
+                            matched[parent] = length[parent]
+                            parent = link[parent]
+                else:
+                    match_length = 0
+
+            common = {state: min(longest, matched[state]) for state, longest in common.items() if state in matched}
+            if not common:
+                return ''
+            if len(common) <= len(word):
+                common_substrings = {s[first_end[state] - longest + 1:first_end[state] + 1] for state, longest in common.items()}
+
+        if not common:
+            return ''
+        longest = max(common.values())
+        start = min(first_end[state] for state, common_length in common.items() if common_length == longest) - longest + 1
+        return s[start:start + longest]
 
     #save rules to .rule output ruleset, final ruleset is sorted according to rule frequency, optionally top n rules are selected
-    def save_frequent_rules_to_file(self):
-        counter = Counter()
-        for rule in self.rules:
-            counter[rule] += 1
+    #save rules to .rule output file, threshold sweep saves rules of each threshold to its own file
+    def save_rules(self):
+        if not self.distance_thresholds:
+            self.save_frequent_rules_to_file()
+            return
+        rule_file, counts_file, clusters_file = self.rule_file, self.counts_file, self.clusters_file
+        for threshold in self.distance_thresholds:
+            self.rule_file = self.sweep_file_name(rule_file, threshold)
+            self.counts_file = self.sweep_file_name(counts_file, threshold) if counts_file else None
+            self.clusters_file = self.sweep_file_name(clusters_file, threshold) if clusters_file else None
+            self.rules, self.most_frequent, self.distance_threshold = self.sweep_rules[threshold], self.sweep_most_frequent[threshold], threshold
+            self.cluster_passes = self.sweep_cluster_passes[threshold]
+            self.save_frequent_rules_to_file()
+        self.rule_file, self.counts_file, self.clusters_file = rule_file, counts_file, clusters_file
+
+    #file of sweep threshold, threshold is inserted before extension, rules.rule -> rules.t3.rule
+    @staticmethod
+    def sweep_file_name(path, threshold):
+        if path.endswith('.gz'):
+            root, extension = os.path.splitext(path[:-3])
+            return f'{root}.t{threshold}{extension}.gz'
+        root, extension = os.path.splitext(path)
+        return f'{root}.t{threshold}{extension}'
+
+    #.txt wordlists of directory in name order, files next to them (distance matrices, neighbourhood caches) are skipped
+    @staticmethod
+    def list_wordlists(directory):
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.txt') and os.path.isfile(os.path.join(directory, name))]
+
+    #wordlists of manifest file, one path per line relative to the manifest, empty lines and # comments are skipped
+    @staticmethod
+    def read_manifest(path):
+        with open(path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+            lines = [line.strip() for line in file]
+        return [os.path.join(os.path.dirname(path), line) for line in lines if line and not line.startswith('#')]
+
+    #file of wordlist of batch, wordlist name is inserted before extension, rules.rule -> rules.rockyou.rule
+    @staticmethod
+    def batch_file_name(path, wordlist):
+        name = os.path.splitext(os.path.basename(wordlist))[0]
+        if path.endswith('.gz'):
+            root, extension = os.path.splitext(path[:-3])
+            return f'{root}.{name}{extension}.gz'
+        root, extension = os.path.splitext(path)
+        return f'{root}.{name}{extension}'
+
+    #generator of one wordlist of batch configured by the same parsed arguments, only its input and output files differ
+    #arguments are not parsed again, so directory or manifest of batch is read once for whole batch
+    #it shares compiled rule priority and rule memo with this generator, so they are built once for whole batch
+    def batch_generator(self, wordlist):
+        args = argparse.Namespace(**vars(self.args))
+        args.wordlist_dir = args.manifest = None
+        args.wordlist = [wordlist]
+        args.rulefile = [self.batch_file_name(self.rule_file, wordlist)]
+        args.counts_file = [self.batch_file_name(self.counts_file, wordlist)] if self.counts_file else None
+        args.save_clusters = [self.batch_file_name(self.clusters_file, wordlist)] if self.clusters_file else None
+        generator = RuleGenerator()
+        generator.apply_args(args)
+        generator.rules_priority, generator.rule_search, generator.rule_priority_fingerprint = self.rules_priority, self.rule_search, self.rule_priority_fingerprint
+        generator.rule_cache = self.rule_cache
+        return generator
+
+    #modules imported lazily by selected clustering method, they are imported before worker processes are forked
+    #so that every worker does not import them again
+    def import_clustering_modules(self):
+        modules = []
+        if (self.HAC and self.distance_thresholds):
+            modules.append('scipy.sparse.csgraph')
+        elif (self.HAC and not self.hac_sparse) or (self.AP and self.ap_engine == 'sklearn'):
+            modules.append('sklearn.cluster')
+        if (self.DBSCAN or self.MDBSCAN or self.hac_sparse):
+            modules.append('symspellpy')
+        if (self.distance_engine == 'symspell'):
+            modules.append('symspellpy.editdistance')
+        for module in modules:
+            importlib.import_module(module)
+
+    #rules of every wordlist of batch saved to its own file, in one process or by batch_jobs worker processes
+    #with combined ranking, counts of wordlists are summed in order of wordlists like merge_rule_counts.py does
+    def process_batch(self):
+        global _rule_generator
+        names = [self.batch_file_name(self.rule_file, wordlist) for wordlist in self.batch_wordlists]
+        if len(set(names)) < len(names):
+            print('Wordlists of batch must have different names, their rule files would overwrite each other.', file=sys.stderr)
+            exit(1)
+
+        combined = Counter()
+        sources = []
+        max_error = 0
+
+        def add_wordlist(wordlist, rules, metadata, statistics):
+            hits, misses, steps, profile = statistics
+            self.rule_cache_hits += hits
+            self.rule_cache_misses += misses
+            self.rule_search_steps += steps
+            if profile is not None:
+                self.profile.merge(profile)
+            if self.verbose:
+                print(f"{wordlist}: rules saved to {self.batch_file_name(self.rule_file, wordlist)}")
+            if self.combined:
+                nonlocal max_error
+                with self.stage('counting'):
+                    combined.update(dict(rules.items()))
+                sources.append(metadata)
+                #overestimations of bounded counters add up
+                max_error += rules.max_error() if isinstance(rules, SpaceSavingCounter) else 0
+
+        if self.batch_jobs > 1 and len(self.batch_wordlists) > 1:
+            self.import_clustering_modules()
+            previous, _rule_generator = _rule_generator, self
+            try:
+                with ProcessPoolExecutor(min(self.batch_jobs, len(self.batch_wordlists)), mp_context=multiprocessing.get_context('fork')) as executor:
+                    for wordlist, (rules, metadata, statistics) in zip(self.batch_wordlists, executor.map(_batch_rule_counter, self.batch_wordlists)):
+                        add_wordlist(wordlist, rules, metadata, statistics)
+            finally:
+                _rule_generator = previous
+        else:
+            for wordlist in self.batch_wordlists:
+                generator = self.batch_generator(wordlist)
+                generator.process_passwords()
+                statistics = (generator.rule_cache_hits, generator.rule_cache_misses, generator.rule_search_steps, generator.profile)
+                add_wordlist(wordlist, generator.rules, generator.run_metadata() if self.combined else None, statistics)
+
+        if self.combined:
+            self.save_combined_rules(combined, sources, max_error)
+        if self.verbose and self.rule_cache_size:
+            self.print_rule_cache_stats()
+
+    #ranking of rules of all wordlists of batch saved to rule file, counts with sources of every wordlist to counts file
+    @profiled_stage('write')
+    def save_combined_rules(self, counter, sources, max_error):
+        with open(self.rule_file, 'w', encoding='utf-8', errors='surrogateescape') as file:
+            for rule, count in counter.most_common(self.most_frequent):
+                file.write(f"{rule}\n")
+        if self.counts_file is not None:
+            save_rule_counts(self.counts_file, counter, sources, max_error)
+
+    @profiled_stage('write')
+    def save_frequent_rules_to_file(self, counter=None):
+        if self.verbose and self.rule_cache_size:
+            self.print_rule_cache_stats()
+
+        if counter is None:
+            counter = self.rules
+
+        if self.verbose and isinstance(counter, SpaceSavingCounter):
+            total = sum(counter.values())
+            if counter.exact():
+                print(f"Rule counter: {total} rules, {len(counter)} distinct, counts are exact")
+            else:
+                print(f"Rule counter: {total} rules, {len(counter)} tracked after {counter.evictions} replacements, counts overestimate by at most {counter.max_error()} (bound {total // counter.capacity})")
 
         with open(self.rule_file , 'w', encoding='utf-8', errors='surrogateescape') as file:
             for rule, count in counter.most_common(self.most_frequent):
                 file.write(f"{rule}\n")
+                self.count('rules_written')
+        self.count('rules_emitted', sum(counter.values()))
+        self.count('distinct_rules', len(counter))
+
+        if self.counts_file is not None:
+            max_error = counter.max_error() if isinstance(counter, SpaceSavingCounter) else 0
+            save_rule_counts(self.counts_file, counter, [self.run_metadata()], max_error)
+
+        if self.clusters_file is not None:
+            save_clusters(self.clusters_file, self.cluster_passes, self.cluster_order, [self.run_metadata()])
+
+    #profiled stage of run, nothing is measured without --profile
+    def stage(self, name):
+        if self.profile is None:
+            return nullcontext()
+        return self.profile.stage(name)
+
+    #add to counter of profile report
+    def count(self, name, value=1):
+        if self.profile is not None:
+            self.profile.counters[name] += value
+
+    #JSON report of stages and counters of profiled run
+    def save_profile(self):
+        report = self.profile.report()
+        report['counters'].update(rule_search_steps=self.rule_search_steps, rule_cache_hits=self.rule_cache_hits, rule_cache_misses=self.rule_cache_misses)
+        document = {'format': 'ruleforge-profile', 'version': 1, 'run': self.run_metadata(), **report}
+        with open(self.profile_file, 'w', encoding='utf-8') as file:
+            json.dump(document, file, indent=2)
+
+    #description of this run stored in rule counts file
+    def run_metadata(self):
+        clustering = next((name for name, used in [("hac_sparse", self.hac_sparse), ("hac", self.HAC), ("ap", self.AP), ("dbscan", self.DBSCAN), ("mdbscan", self.MDBSCAN), ("stdin", self.STDIN)] if used), None)
+        parameters = {name: getattr(self, name) for name in ["distance_threshold", "eps", "min_points", "eps1", "eps2", "dampning", "convergence_iter"] if getattr(self, name, None) is not None}
+        if clustering in ("hac", "ap"):
+            parameters["chunk_size"] = self.chunk_size
+        return {
+            "wordlist": os.path.abspath(self.wordlist) if self.wordlist else None,
+            "wordlist_sha256": self.wordlist_digest().hex() if self.wordlist else None,
+            "clustering": clustering,
+            "parameters": parameters,
+            "representative": self.representative,
+            "remove_outliers": self.remove_outliers,
+            "rule_priority": self.rule_priority_fingerprint,
+            "created": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        }
+
+    #sha256 of wordlist file
+    def wordlist_digest(self):
+        wordlist_hash = hashlib.sha256()
+        with open(self.wordlist, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                wordlist_hash.update(block)
+        return wordlist_hash.digest()
+
+    #counter of generated rules, bounded when rule_counter_size is set
+    def rule_counter(self):
+        if self.rule_counter_size is None:
+            return Counter()
+        return SpaceSavingCounter(self.rule_counter_size)
 
     #convert int to hashcat format
     def int_to_hashcat(self,N):
@@ -526,83 +2056,119 @@ class RuleGenerator:
                 break
         return count
 
+    #compile rule priority into ordered list of candidate generators, called after priority is loaded
+    #each candidate takes (current, target, edit operations) and returns (rule, new password) or None
+    def compile_rule_search(self):
+        self.rule_search = []
+        rule_order = [rule for rule, _ in sorted(self.rules_priority.items(), key=lambda x: x[1]['priority'])]
+        self.rule_priority_fingerprint = hashlib.sha1('\n'.join(rule_order).encode('utf-8', 'surrogateescape')).hexdigest()
+        for rule, details in sorted(self.rules_priority.items(), key=lambda x: x[1]['priority']):
+            candidate = self.rule_candidate(rule, details['func'])
+            if candidate is not None:
+                self.rule_search.append(candidate)
+
+    #candidate generator specialised for one rule, rule strings are built with the same replacements as always
+    def rule_candidate(self, rule, func):
+        int_to_hashcat = self.int_to_hashcat
+        count_duplicate_first = self.count_duplicate_first
+        count_duplicate_last = self.count_duplicate_last
+        arg_count = func.__code__.co_argcount
+
+        if (arg_count == 1):
+            def candidate(current, target, edit_operations):
+                return rule, func(current)
+
+        elif (arg_count == 2):
+            if (rule == "DN" or rule == "TN"):
+                def candidate(current, target, edit_operations):
+                    _, source, destination = edit_operations[0]
+                    if (source < len(current) and destination < len(target)):
+                        new_pass = func(current, source)
+                        return rule.replace("N", int_to_hashcat(source)).replace("X", target[source]), new_pass
+            elif (rule == "zN" or rule == "ZN"):
+                count_duplicate = count_duplicate_first if rule == "zN" else count_duplicate_last
+                def candidate(current, target, edit_operations):
+                    _, source, destination = edit_operations[0]
+                    if (source < len(current) and destination < len(target)):
+                        count = count_duplicate(target)
+                        if (count > 1):
+                            new_pass = func(current, count)
+                            return rule.replace("N", int_to_hashcat(count)).replace("X", target[source]), new_pass
+            elif (rule == "^X"):
+                def candidate(current, target, edit_operations):
+                    #last operation on the first position, operations are ordered by position
+                    last_operation = None
+                    for operation in edit_operations:
+                        if (operation[1] != 0):
+                            break
+                        last_operation = operation
+                    if (last_operation is not None):
+                        new_pass = func(current, target[last_operation[2]])
+                        return rule.replace("X", target[last_operation[2]]), new_pass
+            else:
+                def candidate(current, target, edit_operations):
+                    _, source, destination = edit_operations[0]
+                    if (destination == len(target)):
+                        new_pass = func(current, target[destination - 1])
+                        return rule.replace("N", int_to_hashcat(source)).replace("X", target[destination - 1]), new_pass
+                    new_pass = func(current, target[destination])
+                    return rule.replace("N", int_to_hashcat(source)).replace("X", target[source]), new_pass
+
+        elif (arg_count == 3):
+            if (rule == "iNX" or rule == "oNX"):
+                def candidate(current, target, edit_operations):
+                    _, source, destination = edit_operations[0]
+                    if (source < len(current) and destination < len(target)):
+                        new_pass = func(current, source, target[destination])
+                        return rule.replace("X", target[source]).replace("Y", target[destination]).replace("N", int_to_hashcat(source)), new_pass
+            else:
+                def candidate(current, target, edit_operations):
+                    _, source, destination = edit_operations[0]
+                    if (source < len(current) and destination < len(target)):
+                        new_pass = func(current, current[source], target[destination])
+                        return rule.replace("X", current[source]).replace("Y", target[destination]).replace("N", int_to_hashcat(source)), new_pass
+
+        else:
+            #rule cannot change password
+            return None
+        return candidate
+
     #find applicable rule to decrease edit distance between password and representative
+    #edit operations are computed once, candidates are tried in priority order
     def find_applicable_rule(self, current, target):
-        edit_operations_base = len(lev.editops(current, target))
         edit_operations = lev.editops(current, target)
-        new_pass = current
-        for rule, details in sorted(self.rules_priority.items(), key=lambda x: x[1]['priority']):
-
-            func = details['func']
-            arg_count = func.__code__.co_argcount
-
-            if (arg_count == 1):
-                new_pass = details['func'](current)
-
-            elif (arg_count == 2):
-                if (rule == "DN" or rule == "TN"):
-                        if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
-                            new_pass = details['func'](current, edit_operations[0][1])
-                            rule = rule.replace("N",self.int_to_hashcat(edit_operations[0][1]))
-                            rule = rule.replace("X",target[edit_operations[0][1]])
-                elif (rule == "zN"):
-                    if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
-                        count_first = self.count_duplicate_first(target)
-                        if (count_first > 1):
-                            new_pass = details['func'](current, count_first)
-                            rule = rule.replace("N",self.int_to_hashcat(count_first))
-                            rule = rule.replace("X",target[edit_operations[0][1]])
-                elif (rule == "ZN"):
-                    if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
-                        count_last = self.count_duplicate_last(target)
-                        if (count_last > 1):
-                            new_pass = details['func'](current, count_last)
-                            rule = rule.replace("N", self.int_to_hashcat(count_last))
-                            rule = rule.replace("X",target[edit_operations[0][1]])
-                elif (rule == "^X"):
-                    positions=[]
-                    for op in edit_operations:
-                        if (op[1] == 0):
-                            positions.append(op)
-                
-                    if (len(positions) != 0):
-                        last_operation = positions[-1] 
-                        new_pass = details['func'](current, target[last_operation[2]])
-                        rule = rule.replace("X",target[last_operation[2]])
-                        
-                else: 
-                    if (edit_operations[0][2] == len(target)):
-                        new_pass = details['func'](current, target[edit_operations[0][2]-1])
-                        rule = rule.replace("N",self.int_to_hashcat(edit_operations[0][1]))
-                        rule = rule.replace("X",target[edit_operations[0][2]-1])
-
-                    else:
-                        new_pass = details['func'](current, target[edit_operations[0][2]])
-                        rule = rule.replace("N",self.int_to_hashcat(edit_operations[0][1]))
-                        rule = rule.replace("X",target[edit_operations[0][1]])
+        max_distance = len(edit_operations) - 1
+        for candidate in self.rule_search:
+            result = candidate(current, target, edit_operations)
+            if result is not None and result[1] != current and lev.distance(result[1], target, score_cutoff=max_distance) <= max_distance:
+                return result
             
+    #get rules from password and representant, repeated pairs are served from LRU memo
+    def generate_hashcat_rules(self, representant, password):
+        if self.rule_cache_size == 0:
+            return self.search_hashcat_rules(representant, password)
+
+        key = (self.rule_priority_fingerprint, representant, password)
+        generated_rules = self.rule_cache.get(key)
+        if generated_rules is not None:
+            self.rule_cache_hits += 1
+            self.rule_cache.move_to_end(key)
+            return list(generated_rules)
+
+        self.rule_cache_misses += 1
+        generated_rules = self.search_hashcat_rules(representant, password)
+        self.rule_cache[key] = tuple(generated_rules)
+        if len(self.rule_cache) > self.rule_cache_size:
+            self.rule_cache.popitem(last=False)
+        return generated_rules
 
-            elif (arg_count == 3):
-                if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
-                    if (rule == "iNX" or rule == "oNX"):
-                        new_pass = details['func'](current, edit_operations[0][1], target[edit_operations[0][2]])
-                        rule = rule.replace("X",target[edit_operations[0][1]])
-                        rule = rule.replace("Y",target[edit_operations[0][2]])
-                    else:
-                        new_pass = details['func'](current, current[edit_operations[0][1]], target[edit_operations[0][2]])
-                        rule = rule.replace("X",current[edit_operations[0][1]])
-                        rule = rule.replace("Y",target[edit_operations[0][2]])
-                rule = rule.replace("N",self.int_to_hashcat(edit_operations[0][1]))
-            
+    def print_rule_cache_stats(self):
+        lookups = self.rule_cache_hits + self.rule_cache_misses
+        hit_rate = 100 * self.rule_cache_hits / lookups if lookups else 0
+        print(f"Rule cache: {self.rule_cache_hits} hits, {self.rule_cache_misses} misses ({hit_rate:.1f}% hit rate), {len(self.rule_cache)}/{self.rule_cache_size} entries")
 
-            edit_operations_new = len(lev.editops(new_pass, target))
-            if edit_operations_new < edit_operations_base:
-                return rule, new_pass
-            else:
-                new_pass = current
-            
-    #get rules from password and representant          
-    def generate_hashcat_rules(self, representant, password):
+    #greedy search of rules transforming representant to password
+    def search_hashcat_rules(self, representant, password):
         generated_rules = []
         current_password = representant
         if (current_password == password):
@@ -610,6 +2176,7 @@ class RuleGenerator:
 
         #look for single rules until password is not changed to representant
         while (current_password != password):
+            self.rule_search_steps += 1
             result = self.find_applicable_rule(current_password, password)
             if result is not None:
                 rule, new_password = result
@@ -632,3 +2199,5 @@ if __name__ == "__main__":
     ruleGenerator.process_args()
     ruleGenerator.create_priority_dict_with_functions()
     ruleGenerator.process_passwords()
+    if ruleGenerator.profile is not None:
+        ruleGenerator.save_profile()
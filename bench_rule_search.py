@@ -0,0 +1,129 @@
+import argparse
+import random
+import time
+
+import Levenshtein as lev
+
+from RuleForge import RuleGenerator
+
+
+#original interpreted rule search, kept as reference for the compiled one in RuleGenerator.find_applicable_rule
+def interpreted_find_applicable_rule(generator, current, target):
+    edit_operations_base = len(lev.editops(current, target))
+    edit_operations = lev.editops(current, target)
+    new_pass = current
+    for rule, details in sorted(generator.rules_priority.items(), key=lambda x: x[1]['priority']):
+
+        func = details['func']
+        arg_count = func.__code__.co_argcount
+
+        if (arg_count == 1):
+            new_pass = details['func'](current)
+
+        elif (arg_count == 2):
+            if (rule == "DN" or rule == "TN"):
+                    if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
+                        new_pass = details['func'](current, edit_operations[0][1])
+                        rule = rule.replace("N",generator.int_to_hashcat(edit_operations[0][1]))
+                        rule = rule.replace("X",target[edit_operations[0][1]])
+            elif (rule == "zN"):
+                if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
+                    count_first = generator.count_duplicate_first(target)
+                    if (count_first > 1):
+                        new_pass = details['func'](current, count_first)
+                        rule = rule.replace("N",generator.int_to_hashcat(count_first))
+                        rule = rule.replace("X",target[edit_operations[0][1]])
+            elif (rule == "ZN"):
+                if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
+                    count_last = generator.count_duplicate_last(target)
+                    if (count_last > 1):
+                        new_pass = details['func'](current, count_last)
+                        rule = rule.replace("N", generator.int_to_hashcat(count_last))
+                        rule = rule.replace("X",target[edit_operations[0][1]])
+            elif (rule == "^X"):
+                positions=[]
+                for op in edit_operations:
+                    if (op[1] == 0):
+                        positions.append(op)
+
+                if (len(positions) != 0):
+                    last_operation = positions[-1]
+                    new_pass = details['func'](current, target[last_operation[2]])
+                    rule = rule.replace("X",target[last_operation[2]])
+
+            else:
+                if (edit_operations[0][2] == len(target)):
+                    new_pass = details['func'](current, target[edit_operations[0][2]-1])
+                    rule = rule.replace("N",generator.int_to_hashcat(edit_operations[0][1]))
+                    rule = rule.replace("X",target[edit_operations[0][2]-1])
+
+                else:
+                    new_pass = details['func'](current, target[edit_operations[0][2]])
+                    rule = rule.replace("N",generator.int_to_hashcat(edit_operations[0][1]))
+                    rule = rule.replace("X",target[edit_operations[0][1]])
+
+
+        elif (arg_count == 3):
+            if (edit_operations[0][1] < len(current) and edit_operations[0][2] < len(target)):
+                if (rule == "iNX" or rule == "oNX"):
+                    new_pass = details['func'](current, edit_operations[0][1], target[edit_operations[0][2]])
+                    rule = rule.replace("X",target[edit_operations[0][1]])
+                    rule = rule.replace("Y",target[edit_operations[0][2]])
+                else:
+                    new_pass = details['func'](current, current[edit_operations[0][1]], target[edit_operations[0][2]])
+                    rule = rule.replace("X",current[edit_operations[0][1]])
+                    rule = rule.replace("Y",target[edit_operations[0][2]])
+            rule = rule.replace("N",generator.int_to_hashcat(edit_operations[0][1]))
+
+
+        edit_operations_new = len(lev.editops(new_pass, target))
+        if edit_operations_new < edit_operations_base:
+            return rule, new_pass
+        else:
+            new_pass = current
+
+
+#(representative, password) pairs - password with its lowercased, de-leeted and truncated variants and random pairs
+def transformation_pairs(generator, passwords, count):
+    random.seed(0)
+    pairs = []
+    while len(pairs) < count:
+        password = random.choice(passwords)
+        pairs.append((generator.remove_leetspeak(password.lower()), password))
+        pairs.append((password[:max(1, len(password) // 2)], password))
+        pairs.append((random.choice(passwords), password))
+    return pairs[:count]
+
+
+def time_search(generator, pairs, find_applicable_rule):
+    generator.find_applicable_rule = find_applicable_rule
+    start = time.perf_counter()
+    results = [generator.generate_hashcat_rules(representative, password) for representative, password in pairs]
+    return time.perf_counter() - start, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bench_rule_search', description='Compares compiled and interpreted rule search of RuleGenerator.')
+    parser.add_argument('--wordlist', default='dictionaries/experiments/darkweb2017-top10k-m.txt')
+    parser.add_argument('--rule_priority')
+    parser.add_argument('--pairs', type=int, default=20000)
+    args = parser.parse_args()
+
+    generator = RuleGenerator()
+    generator.rule_priority_file = args.rule_priority
+    generator.rule_cache_size = 0 #time the search itself, not the memo
+    generator.create_priority_dict_with_functions()
+    with open(args.wordlist, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        passwords = [word for line in file for word in line.split()]
+    pairs = transformation_pairs(generator, passwords, args.pairs)
+
+    compiled = generator.find_applicable_rule
+    interpreted = lambda current, target: interpreted_find_applicable_rule(generator, current, target)
+    interpreted_time, interpreted_results = time_search(generator, pairs, interpreted)
+    compiled_time, compiled_results = time_search(generator, pairs, compiled)
+
+    mismatches = sum(a != b for a, b in zip(interpreted_results, compiled_results))
+    print(f'pairs,interpreted,compiled,speedup,mismatches')
+    print(f'{len(pairs)},{interpreted_time:.3f},{compiled_time:.3f},{interpreted_time / compiled_time:.2f},{mismatches}')
+    if mismatches:
+        exit(1)
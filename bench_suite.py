@@ -0,0 +1,319 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from RuleForge import RuleGenerator, StageProfile
+from bench_rule_search import transformation_pairs
+
+
+BENCHMARKS_FORMAT = 'ruleforge-benchmarks'
+BENCHMARKS_VERSION = 1
+
+EXPERIMENT_WORDLISTS = ['darkweb2017-top10k-m.txt', '10-million-list-top10000.txt', 'Xato-net-100k.txt']
+
+
+#shortest time of repeated calls, function is called once before to warm up caches
+def measure(function, repeat):
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def load_wordlist(path, count):
+    words = []
+    with open(path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        for line in file:
+            words.extend(line.split())
+            if len(words) >= count:
+                break
+    return words[:count]
+
+#synthetic wordlist of count passwords with lengths drawn from normal distribution, clipped to [1, max_length]
+#a share of passwords are variants of earlier ones (case, appended digits, substituted characters) so clusters form
+def synthetic_wordlist(count, mean_length=8, length_deviation=2, max_length=32, variant_share=0.5, seed=0):
+    generator = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    words = []
+    while len(words) < count:
+        if words and generator.random() < variant_share:
+            word = generator.choice(words)
+            variant = generator.randrange(3)
+            if variant == 0:
+                word = word.capitalize()
+            elif variant == 1:
+                word = word + str(generator.randrange(100))
+            else:
+                position = generator.randrange(len(word))
+                word = word[:position] + generator.choice(alphabet) + word[position+1:]
+        else:
+            length = min(max_length, max(1, round(generator.gauss(mean_length, length_deviation))))
+            word = ''.join(generator.choice(alphabet) for _ in range(length))
+        words.append(word)
+    return words
+
+#clusters of variants of random words of wordlist, for longest common substring
+def synthetic_clusters(words, count, seed=0):
+    generator = random.Random(seed)
+    clusters = []
+    for _ in range(count):
+        base = generator.choice(words)
+        size = generator.randint(2, 50)
+        clusters.append([base[:generator.randrange(len(base) + 1)] + str(generator.randrange(1000)) + base[generator.randrange(len(base) + 1):] for _ in range(size)])
+    return clusters
+
+def rule_generator(arguments=('--hac',)):
+    generator = RuleGenerator()
+    generator.process_args(['--wordlist', os.devnull, '--rulefile', os.devnull, '--representative', 'combo', *arguments])
+    generator.create_priority_dict_with_functions()
+    return generator
+
+
+#microbenchmarks of rule search - single step, whole transformation with and without memo
+def bench_rule_search(words, pairs_count, repeat):
+    generator = rule_generator()
+    pairs = transformation_pairs(generator, words, pairs_count)
+    first_steps = [(representative, password) for representative, password in pairs if representative != password]
+    generator.rule_cache_size = 0
+    results = {
+        'find_applicable_rule': measure(lambda: [generator.find_applicable_rule(representative, password) for representative, password in first_steps], repeat) / len(first_steps),
+        'generate_hashcat_rules/search': measure(lambda: [generator.generate_hashcat_rules(representative, password) for representative, password in pairs], repeat) / len(pairs),
+    }
+    generator.rule_cache_size = len(pairs)
+    results['generate_hashcat_rules/memo'] = measure(lambda: [generator.generate_hashcat_rules(representative, password) for representative, password in pairs], repeat) / len(pairs)
+    return results
+
+def bench_longest_common_substring(words, clusters_count, repeat):
+    generator = rule_generator()
+    clusters = [[generator.remove_leetspeak(password.lower()) for password in cluster] for cluster in synthetic_clusters(words, clusters_count)]
+    return {'find_longest_common_substring': measure(lambda: [generator.find_longest_common_substring(cluster) for cluster in clusters], repeat) / len(clusters)}
+
+#distance matrix of one chunk with every engine, clustering is not timed
+def bench_distance_matrix(words, repeat, engines=('batched', 'pruned', 'symspell')):
+    results = {}
+    for engine in engines:
+        arguments = ['--distance_pruning'] if engine == 'pruned' else ['--distance_engine', engine]
+        generator = rule_generator(['--hac', *arguments])
+        generator.chunks = [words]
+        generator.select_clustering = lambda: None
+        results[f'distance_matrix/{engine}'] = measure(generator.chunk_edit_distance, repeat)
+    return results
+
+#stages of whole run of RuleForge.py on wordlist from its profile, the fastest of repeated runs after a warm-up run
+def bench_pipeline(words, method_arguments, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        wordlist = os.path.join(directory, 'wordlist.txt')
+        with open(wordlist, 'w', encoding='utf-8', errors='surrogateescape') as file:
+            file.write('\n'.join(words) + '\n')
+        best = None
+        for run in range(repeat + 1):
+            generator = rule_generator(['--wordlist', wordlist, '--rulefile', os.path.join(directory, 'rules.rule'), '--no_neighbourhood_cache', *method_arguments])
+            generator.profile = StageProfile()
+            generator.process_passwords()
+            report = generator.profile.report()
+            if run > 0 and (best is None or report['wall_time'] < best['wall_time']):
+                best = report
+    results = {f'stage/{name}': stage['wall_time'] for name, stage in best['stages'].items()}
+    results['total'] = best['wall_time']
+    return results
+
+#log-log slope of time over n, 1 is linear and 2 is quadratic scaling
+def scaling_exponent(points):
+    sizes = [math.log(n) for n, _ in points]
+    times = [math.log(max(seconds, 1e-9)) for _, seconds in points]
+    mean_size, mean_time = sum(sizes) / len(sizes), sum(times) / len(times)
+    variance = sum((size - mean_size) ** 2 for size in sizes)
+    return sum((size - mean_size) * (t - mean_time) for size, t in zip(sizes, times)) / variance if variance else 0.0
+
+
+#RuleForge.py arguments of each mode whose startup is measured, import only imports the module
+#heavy dependencies are imported by the selected method, so each mode pays only for its own
+STARTUP_MODES = {
+    'import': None,
+    'stdin': ['--stdin'],
+    'hac': ['--hac'],
+    'hac_sweep': ['--hac', '--distance_thresholds', '2', '3'],
+    'hac_sparse': ['--hac', '--hac_sparse', '--no_neighbourhood_cache'],
+    'ap': ['--ap'],
+    'ap_lean': ['--ap', '--ap_engine', 'lean'],
+    'dbscan': ['--dbscan', '--no_neighbourhood_cache'],
+}
+
+#startup budgets in seconds, a run over budget fails the suite like a regression
+#modes without sklearn must stay far below the second its import takes
+STARTUP_BUDGETS = {
+    'import': 0.4,
+    'stdin': 0.5,
+    'hac': 2.5,
+    'hac_sweep': 1.0,
+    'hac_sparse': 0.6,
+    'ap': 2.5,
+    'ap_lean': 0.6,
+    'dbscan': 0.6,
+}
+
+#wall time of new process running RuleForge.py on tiny input in each mode, mostly imports and argument parsing
+def bench_startup(repeat):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'RuleForge.py')
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        wordlist = os.path.join(directory, 'wordlist.txt')
+        clusters = os.path.join(directory, 'clusters.json')
+        words = synthetic_wordlist(20)
+        with open(wordlist, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(words) + '\n')
+        with open(clusters, 'w', encoding='utf-8') as file:
+            json.dump({'0': {'Item1': words[:5], 'Item2': words[0]}}, file)
+        for mode, arguments in STARTUP_MODES.items():
+            if arguments is None:
+                command = [sys.executable, '-c', 'import RuleForge']
+            else:
+                command = [sys.executable, script, '--wordlist', wordlist, '--rulefile', os.path.join(directory, 'rules.rule'), '--representative', 'combo', *arguments]
+
+            def run():
+                with open(clusters, 'rb') as stdin:
+                    subprocess.run(command, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=os.path.dirname(script), check=True)
+            results[mode] = measure(run, repeat)
+    return results
+
+#modes whose startup exceeds its budget
+def over_budget(results):
+    exceeded = []
+    for mode, budget in STARTUP_BUDGETS.items():
+        seconds = results.get(f'startup/{mode}')
+        if seconds is not None and seconds > budget:
+            print(f'startup/{mode},{seconds:.3f} s over budget of {budget} s', file=sys.stderr)
+            exceeded.append(mode)
+    return exceeded
+
+
+METHODS = {
+    'hac': ['--hac', '--distance_threshold', '3'],
+    'ap': ['--ap', '--ap_engine', 'lean'],
+    'dbscan': ['--dbscan', '--eps', '1', '--min_points', '3'],
+}
+
+def run_benchmarks(selected, quick, repeat, lengths):
+    sizes = [250, 500, 1000] if quick else [500, 1000, 2000, 4000]
+    results = {}
+    curves = {}
+
+    #benchmark group is run when it is within or contains one of selected prefixes
+    def enabled(group):
+        return not selected or any(group.startswith(prefix) or prefix.startswith(group) for prefix in selected)
+
+    def add(prefix, measurements):
+        for name, seconds in measurements.items():
+            results[f'{prefix}/{name}'] = seconds
+            print(f'{prefix}/{name},{seconds:.6g}', flush=True)
+
+    if enabled('startup'):
+        add('startup', bench_startup(repeat))
+
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dictionaries', 'experiments')
+    wordlists = {name: os.path.join(directory, name) for name in EXPERIMENT_WORDLISTS if os.path.isfile(os.path.join(directory, name))}
+    chunk = 1000 if quick else 2000
+    for name, path in wordlists.items():
+        words = load_wordlist(path, chunk)
+        if enabled(f'micro/{name}'):
+            add(f'micro/{name}', bench_rule_search(words, 500 if quick else 2000, repeat))
+            add(f'micro/{name}', bench_longest_common_substring(words, 100 if quick else 400, repeat))
+        if enabled(f'distance/{name}'):
+            add(f'distance/{name}/n={len(words)}', bench_distance_matrix(words, repeat, ('batched', 'pruned')))
+        for method, arguments in METHODS.items():
+            if enabled(f'pipeline/{method}/{name}'):
+                add(f'pipeline/{method}/{name}/n={len(words)}', bench_pipeline(words, arguments, repeat))
+
+    mean_length, length_deviation = lengths
+    if enabled('distance/synthetic'):
+        #pure python engine only on the smallest list
+        add(f'distance/synthetic/n={sizes[0]}', bench_distance_matrix(synthetic_wordlist(sizes[0], mean_length, length_deviation), repeat, ('symspell',)))
+    for method, arguments in METHODS.items():
+        if not enabled(f'scaling/{method}'):
+            continue
+        for n in sizes:
+            words = synthetic_wordlist(n, mean_length, length_deviation)
+            measurements = bench_pipeline(words, arguments, repeat)
+            add(f'scaling/{method}/n={n}', measurements)
+            curves.setdefault(method, []).append((n, measurements['total']))
+        curves[method] = {'points': curves[method], 'exponent': scaling_exponent(curves[method])}
+        print(f'scaling/{method}/exponent,{curves[method]["exponent"]:.2f}', flush=True)
+    return results, curves
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+#benchmarks present in both documents with ratio of current and baseline time, regressions are slower than tolerance allows
+def compare(baseline, current, tolerance):
+    regressions = []
+    print('benchmark,baseline,current,ratio')
+    for name, seconds in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = seconds / baseline['results'][name] if baseline['results'][name] else float('inf')
+        regressed = ratio > 1 + tolerance
+        print(f'{name},{baseline["results"][name]:.6g},{seconds:.6g},{ratio:.2f}{" REGRESSION" if regressed else ""}')
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+#benchmarks of RuleGenerator stages run in process on experiment wordlists and synthetic wordlists
+#results are times in seconds (per call for micro benchmarks), saved as JSON baseline and compared with earlier one
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='bench_suite', description='Benchmarks RuleForge stages and compares them with a baseline.')
+    parser.add_argument('--output', nargs=1) #save results as JSON baseline
+    parser.add_argument('--compare', nargs=1) #baseline to compare results with, exits with 1 on regression
+    parser.add_argument('--tolerance', type=float, default=0.1) #allowed slowdown against baseline
+    parser.add_argument('--only', nargs='+') #run only benchmarks with these name prefixes, e.g. startup micro distance pipeline/hac scaling
+    parser.add_argument('--quick', action='store_true') #smaller wordlists and fewer sizes
+    parser.add_argument('--repeat', type=int, default=3) #best of this many runs of each benchmark
+    parser.add_argument('--lengths', type=float, nargs=2, default=[8, 2]) #mean and deviation of synthetic password lengths
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        try:
+            with open(args.compare[0], 'r', encoding='utf-8') as file:
+                baseline = json.load(file)
+        except (OSError, ValueError) as error:
+            print(f'Cannot read baseline: {error}', file=sys.stderr)
+            exit(1)
+        if baseline.get('format') != BENCHMARKS_FORMAT or baseline.get('version') != BENCHMARKS_VERSION:
+            print(f'{args.compare[0]} is not a benchmarks file', file=sys.stderr)
+            exit(1)
+
+    print('benchmark,seconds')
+    results, curves = run_benchmarks(args.only, args.quick, max(1, args.repeat), args.lengths)
+    document = {
+        'format': BENCHMARKS_FORMAT,
+        'version': BENCHMARKS_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'quick': args.quick,
+        'results': results,
+        'scaling': curves,
+    }
+    if args.output:
+        with open(args.output[0], 'w', encoding='utf-8') as file:
+            json.dump(document, file, indent=2)
+
+    exceeded = over_budget(results)
+    if (baseline is not None and compare(baseline, document, args.tolerance)) or exceeded:
+        exit(1)
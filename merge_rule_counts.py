@@ -0,0 +1,45 @@
+import argparse
+import sys
+
+from RuleForge import load_rule_counts, save_rule_counts
+
+
+#merge rule counts files of separate RuleForge runs (--counts_file) into one ranked rule file
+#counts are summed in order of given files, so ties are ranked like in a single run over shards in that order
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='merge_rule_counts', description='Merges rule counts files of RuleForge runs into one ranked rule file.')
+    parser.add_argument('counts_files', nargs='+')
+    parser.add_argument('--rulefile', nargs=1)
+    parser.add_argument('--most_frequent', nargs=1)
+    parser.add_argument('--counts_file', nargs=1) #save merged counts, for merging them further
+    args = parser.parse_args()
+
+    if not (args.rulefile or args.counts_file):
+        print('You must select a rulefile or counts file.', file=sys.stderr)
+        exit(1)
+
+    counter = None
+    sources = []
+    max_error = 0
+    for path in args.counts_files:
+        try:
+            counts, document = load_rule_counts(path)
+        except (OSError, ValueError) as error:
+            print(f'Cannot read rule counts: {error}', file=sys.stderr)
+            exit(1)
+        if counter is None:
+            counter = counts
+        else:
+            counter.update(counts)
+        sources.extend(document.get('sources', []))
+        #overestimations of bounded counters add up
+        max_error += document.get('max_error', 0)
+
+    if args.rulefile:
+        most_frequent = int(args.most_frequent[0]) if args.most_frequent else None
+        with open(args.rulefile[0], 'w', encoding='utf-8', errors='surrogateescape') as file:
+            for rule, count in counter.most_common(most_frequent):
+                file.write(f"{rule}\n")
+
+    if args.counts_file:
+        save_rule_counts(args.counts_file[0], counter, sources, max_error)
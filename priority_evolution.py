@@ -0,0 +1,169 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+from RuleForge import RuleGenerator, load_clusters
+from rule_evaluator import evaluate_rules, load_words, wordlist_paths
+
+
+#rules whose priority is evolved, rule ':' always comes first, same as in rule-priority-evolution.ipynb
+EVOLVED_RULES = ["l", "u", "c", "t", "TN", "zN", "ZN", "[", "]", "$X", "^X", "DN", "iNX", "oNX", "}", "{", "r", "sXY"]
+
+#rules ordered by priority vector like rearrange_rules_by_priority of the notebook, equal priorities are ordered by rule
+def priority_order(priorities):
+    return tuple(rule for _, rule in sorted(zip(priorities, EVOLVED_RULES)))
+
+
+#evolution shared with forked worker processes, with loaded clusters and wordlists
+_evolution = None
+
+def _order_fitness(order):
+    return _evolution.order_fitness(order)
+
+
+#fitness of rule priorities - negative average hit rate of rules generated from saved clusters (--save_clusters)
+#clusters are loaded once, so only rules are generated for each priority; individuals of population are evaluated
+#by worker processes and fitness of every rule order is memoized, different vectors often give the same order
+class PriorityEvolution:
+    def __init__(self, clusters_files, attack_words, targets, most_frequent=None, jobs=1):
+        self.clusterings = []
+        for path in clusters_files:
+            document = load_clusters(path)
+            source = document['sources'][0] if document.get('sources') else {}
+            generator = RuleGenerator()
+            generator.representative = source.get('representative') or 'combo'
+            generator.remove_outliers = source.get('remove_outliers', False)
+            self.clusterings.append((generator, document))
+        self.attack_words = list(dict.fromkeys(attack_words))
+        self.targets = [set(passwords) for passwords in targets]
+        self.all_targets = set().union(*self.targets)
+        self.most_frequent = most_frequent
+        self.jobs = jobs
+        self.fitness_cache = {} #rule order -> fitness
+        self.requests = 0
+
+    #negative hit rate of rules generated with rule order, averaged over clusterings and target wordlists
+    def order_fitness(self, order):
+        hit_rates = []
+        for generator, document in self.clusterings:
+            generator.set_rule_priority([':'] + list(order))
+            generator.rules = generator.rule_counter()
+            generator.most_frequent = self.most_frequent
+            generator.rules_from_saved_clusters(document)
+            rule_lines = [rule for rule, _ in generator.rules.most_common(generator.most_frequent)]
+            cracked = evaluate_rules(rule_lines, self.attack_words, self.all_targets)
+            hit_rates.append(sum(len(cracked & passwords) / len(passwords) for passwords in self.targets) / len(self.targets))
+        return -sum(hit_rates) / len(hit_rates)
+
+    #fitness of every priority vector of population, vectors with repeated priorities get infinite fitness like in the notebook
+    #rule orders not seen before are evaluated at once by worker processes
+    def evaluate(self, population):
+        global _evolution
+        orders = [priority_order(priorities) if len(set(priorities)) == len(priorities) else None for priorities in population]
+        self.requests += len(orders)
+        pending = list(dict.fromkeys(order for order in orders if order is not None and order not in self.fitness_cache))
+        if self.jobs > 1 and len(pending) > 1:
+            _evolution = self
+            try:
+                with multiprocessing.get_context('fork').Pool(min(self.jobs, len(pending))) as pool:
+                    for order, fitness in zip(pending, pool.map(_order_fitness, pending)):
+                        self.fitness_cache[order] = fitness
+            finally:
+                _evolution = None
+        else:
+            for order in pending:
+                self.fitness_cache[order] = self.order_fitness(order)
+        return [self.fitness_cache[order] if order is not None else np.inf for order in orders]
+
+    #fitness of one priority vector, can be passed as function of geneticalgorithm
+    def fitness(self, priorities):
+        return self.evaluate([priorities])[0]
+
+    #genetic algorithm with parameters of the notebook, whole generation is evaluated at once
+    #elite individuals survive, parents are chosen by roulette, children by uniform crossover and random mutation
+    #yields (iteration, best priorities, best fitness) after every generation
+    def evolve(self, population_size=10, max_iterations=25, mutation_probability=0.3, elit_ratio=0.1, crossover_probability=0.5,
+               parents_portion=0.4, max_iterations_without_improvement=4, bounds=(1, 1000), seed=None):
+        random = np.random.default_rng(seed)
+        dimension = len(EVOLVED_RULES)
+        population = random.integers(bounds[0], bounds[1], size=(population_size, dimension), endpoint=True)
+        fitness = np.array(self.evaluate(population.tolist()))
+        elites = max(1, int(elit_ratio * population_size))
+        parents = max(elites, int(parents_portion * population_size))
+
+        best_fitness = np.inf
+        without_improvement = 0
+        for iteration in range(1, max_iterations + 1):
+            ranking = np.argsort(fitness, kind='stable')
+            population, fitness = population[ranking], fitness[ranking]
+            if fitness[0] < best_fitness:
+                best_fitness, without_improvement = fitness[0], 0
+            else:
+                without_improvement += 1
+            yield iteration, population[0].tolist(), best_fitness
+            if without_improvement >= max_iterations_without_improvement:
+                return
+
+            #roulette over the rest, infinite fitness is never chosen
+            finite = np.isfinite(fitness[elites:])
+            weights = np.where(finite, np.max(fitness[elites:][finite], initial=0) - fitness[elites:] + 1, 0)
+            if np.count_nonzero(weights) >= parents - elites:
+                chosen = random.choice(np.arange(elites, population_size), size=parents - elites, replace=False, p=weights / weights.sum())
+            else:
+                chosen = np.arange(elites, parents)
+            parent_pool = np.concatenate([population[:elites], population[chosen]])
+
+            children = []
+            while len(children) < population_size - parents:
+                first, second = parent_pool[random.choice(len(parent_pool), size=2)]
+                if random.random() < crossover_probability:
+                    swap = random.random(dimension) < 0.5
+                    first, second = np.where(swap, second, first), np.where(swap, first, second)
+                for child in (first, second):
+                    mutation = random.random(dimension) < mutation_probability
+                    children.append(np.where(mutation, random.integers(bounds[0], bounds[1], size=dimension, endpoint=True), child))
+            children = np.array(children[:population_size - parents], dtype=population.dtype).reshape(-1, dimension)
+            population = np.concatenate([parent_pool, children])
+            fitness = np.concatenate([fitness[:elites], fitness[chosen], self.evaluate(children.tolist())])
+
+
+#evolve rule priority on clusters saved by RuleForge.py --save_clusters, e.g. of HAC, DBSCAN and MDBSCAN runs
+#prints best hit rate of every generation and writes the best rule priority file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='priority_evolution', description='Evolves rule priority of RuleForge on saved clusters.')
+    parser.add_argument('--clusters', nargs='+', required=True) #clusters files saved by RuleForge.py --save_clusters
+    parser.add_argument('--attack', nargs='+', required=True) #attack wordlists or directories of them, e.g. dictionaries/evolution/1_attack
+    parser.add_argument('--target', nargs='+', required=True) #target wordlists or directories of them, e.g. dictionaries/evolution/2_target
+    parser.add_argument('--most_frequent', type=int) #number of generated rules evaluated
+    parser.add_argument('--population_size', type=int, default=10)
+    parser.add_argument('--max_iterations', type=int, default=25)
+    parser.add_argument('--max_iterations_without_improvement', type=int, default=4)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--jobs', type=int, default=0) #number of processes evaluating individuals, 0 uses all cores
+    parser.add_argument('--output', default='rules_priority.best.txt') #best rule priority, used with RuleForge.py --rule_priority
+    args = parser.parse_args()
+
+    try:
+        attack_words = [word for path in args.attack for word in load_words(path)]
+        targets = [load_words(target_path) for path in args.target for target_path in wordlist_paths(path)]
+        evolution = PriorityEvolution(args.clusters, attack_words, targets, args.most_frequent, args.jobs if args.jobs > 0 else (os.cpu_count() or 1))
+    except (OSError, ValueError) as error:
+        print(f'Cannot read input: {error}', file=sys.stderr)
+        exit(1)
+
+    start = time.perf_counter()
+    best = None
+    print('iteration,best_hit_rate,evaluated,requested,seconds')
+    for iteration, priorities, fitness in evolution.evolve(population_size=args.population_size, max_iterations=args.max_iterations,
+                                                           max_iterations_without_improvement=args.max_iterations_without_improvement, seed=args.seed):
+        best = priorities
+        print(f'{iteration},{-fitness:.2%},{len(evolution.fitness_cache)},{evolution.requests},{time.perf_counter() - start:.1f}', flush=True)
+
+    with open(args.output, 'w') as file:
+        file.write(':\n')
+        for rule in priority_order(best):
+            file.write(f'{rule}\n')
@@ -0,0 +1,225 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+
+#hashcat positions 0-9 and A-Z, see RuleGenerator.int_to_hashcat
+HASHCAT_POSITIONS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+#hashcat rule functions as (argument kinds, expression of word and arguments), N is position and X is character
+#arguments are named n, m for positions and x, y for characters in order of their kind
+#functions with position out of word leave the word unchanged, as hashcat does
+RULE_FUNCTIONS = {
+    ':': ('', 'word'),
+    'l': ('', 'word.lower()'),
+    'u': ('', 'word.upper()'),
+    'c': ('', 'word.capitalize()'),
+    'C': ('', 'word[:1].lower() + word[1:].upper()'),
+    't': ('', 'word.swapcase()'),
+    'T': ('N', 'word[:n] + word[n].swapcase() + word[n+1:] if n < len(word) else word'),
+    'r': ('', 'word[::-1]'),
+    'd': ('', 'word + word'),
+    'p': ('N', 'word * (n + 1)'),
+    'f': ('', 'word + word[::-1]'),
+    '{': ('', 'word[1:] + word[:1]'),
+    '}': ('', 'word[-1:] + word[:-1]'),
+    '$': ('X', 'word + x'),
+    '^': ('X', 'x + word'),
+    '[': ('', 'word[1:]'),
+    ']': ('', 'word[:-1]'),
+    'D': ('N', 'word[:n] + word[n+1:]'),
+    'x': ('NN', 'word[n:n+m] if n < len(word) and n + m <= len(word) else word'),
+    'O': ('NN', 'word[:n] + word[n+m:] if n < len(word) and n + m <= len(word) else word'),
+    'i': ('NX', 'word[:n] + x + word[n:] if n <= len(word) else word'),
+    'o': ('NX', 'word[:n] + x + word[n+1:] if n < len(word) else word'),
+    "'": ('N', 'word[:n]'),
+    's': ('XX', 'word.replace(x, y)'),
+    '@': ('X', "word.replace(x, '')"),
+    'z': ('N', 'word[:1] * n + word'),
+    'Z': ('N', 'word + word[-1:] * n'),
+    'q': ('', "''.join(character * 2 for character in word)"),
+    'k': ('', 'word[1::-1] + word[2:]'),
+    'K': ('', 'word[:-2] + word[:-3:-1] if len(word) >= 2 else word'),
+    '*': ('NN', 'swap_characters(word, n, m)'),
+    'y': ('N', 'word[:n] + word if n <= len(word) else word'),
+    'Y': ('N', 'word + word[len(word)-n:] if n <= len(word) else word'),
+    'E': ('', "' '.join(part[:1].upper() + part[1:] for part in word.lower().split(' '))"),
+}
+
+
+def swap_characters(word, n, m):
+    if n >= len(word) or m >= len(word):
+        return word
+    characters = list(word)
+    characters[n], characters[m] = characters[m], characters[n]
+    return ''.join(characters)
+
+def argument_names(kinds):
+    positions, characters = iter('nm'), iter('xy')
+    return ''.join(', ' + next(positions if kind == 'N' else characters) for kind in kinds)
+
+#each rule function compiled for one word and for whole list of words, the list is transformed in one comprehension
+WORD_FUNCTIONS = {name: eval(f'lambda word{argument_names(kinds)}: {expression}') for name, (kinds, expression) in RULE_FUNCTIONS.items()}
+BATCH_FUNCTIONS = {name: eval(f'lambda words{argument_names(kinds)}: [{expression} for word in words]') for name, (kinds, expression) in RULE_FUNCTIONS.items()}
+
+
+#functions of hashcat rule line as (name, arguments), ValueError when rule cannot be applied
+#functions may be separated by spaces, a space is an argument only where character is expected
+def parse_rule(line):
+    steps = []
+    position = 0
+    while position < len(line):
+        name = line[position]
+        position += 1
+        if name == ' ':
+            continue
+        if name not in RULE_FUNCTIONS:
+            raise ValueError(f'unsupported rule function {name!r} in {line!r}')
+        kinds, _ = RULE_FUNCTIONS[name]
+        if position + len(kinds) > len(line):
+            raise ValueError(f'missing argument of {name!r} in {line!r}')
+        arguments = []
+        for kind in kinds:
+            argument = line[position]
+            position += 1
+            if kind == 'N':
+                if argument not in HASHCAT_POSITIONS:
+                    raise ValueError(f'invalid position {argument!r} in {line!r}')
+                argument = HASHCAT_POSITIONS.index(argument)
+            arguments.append(argument)
+        steps.append((name, tuple(arguments)))
+    return steps
+
+#function transforming word by whole rule line
+def compile_rule(line):
+    steps = [(WORD_FUNCTIONS[name], arguments) for name, arguments in parse_rule(line)]
+
+    def rule(word):
+        for function, arguments in steps:
+            word = function(word, *arguments)
+        return word
+    return rule
+
+#rule lines of .rule file in their order, comments and empty lines are skipped
+def load_rules(path):
+    with open(path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        return [line for line in file.read().splitlines() if line and not line.startswith('#')]
+
+#wordlist files of path, .txt files of directory in name order like RuleGenerator.list_wordlists
+#hidden files are skipped, e.g. neighbourhood caches RuleForge writes next to wordlists
+def wordlist_paths(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.txt') and not name.startswith('.') and os.path.isfile(os.path.join(path, name))]
+    return [path]
+
+#lines of wordlist files, directories are read file by file
+def load_words(path):
+    words = []
+    for file_path in wordlist_paths(path):
+        with open(file_path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+            words.extend(line for line in file.read().splitlines() if line)
+    return words
+
+
+#attack words and target passwords shared with forked worker processes
+_attack_words = None
+_targets = None
+
+#targets cracked by batch of rule lines applied to all attack words
+#rules are walked as prefix tree, so words transformed by common prefix of rules are computed once
+#rules that cannot be parsed are skipped, e.g. rules RuleForge generates with positions beyond Z for long passwords
+def _cracked_by_rules(rule_lines):
+    tree = {}
+    for line in rule_lines:
+        try:
+            steps = parse_rule(line)
+        except ValueError:
+            continue
+        node = tree
+        for step in steps:
+            node = node.setdefault(step, {})
+        node[None] = None #rule ends here
+
+    cracked = set()
+    stack = [(tree, None, _attack_words)]
+    while stack:
+        node, step, words = stack.pop()
+        if step is not None:
+            name, arguments = step
+            words = BATCH_FUNCTIONS[name](words, *arguments)
+        for child_step, child in node.items():
+            if child_step is None:
+                cracked.update(_targets.intersection(words))
+            else:
+                stack.append((child, child_step, words))
+    return cracked
+
+#target passwords cracked by rules applied to attack words, rules are applied in batches by given number of processes
+#rules are batched in sorted order, so rules with common prefix mostly fall into the same batch
+def evaluate_rules(rule_lines, attack_words, targets, jobs=1, batch_size=64):
+    global _attack_words, _targets
+    _attack_words, _targets = list(dict.fromkeys(attack_words)), set(targets)
+    try:
+        if jobs <= 1 or len(rule_lines) <= batch_size:
+            return _cracked_by_rules(rule_lines)
+        rule_lines = sorted(rule_lines)
+        batches = [rule_lines[start:start+batch_size] for start in range(0, len(rule_lines), batch_size)]
+        cracked = set()
+        with multiprocessing.get_context('fork').Pool(min(jobs, len(batches))) as pool:
+            for batch_cracked in pool.imap_unordered(_cracked_by_rules, batches):
+                cracked.update(batch_cracked)
+        return cracked
+    finally:
+        _attack_words, _targets = None, None
+
+
+#hit rate of rule file - share of unique target passwords produced by rules from attack wordlist
+#rows follow statistics of testing scripts, average hit rate is the fourth field of the last row
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='rule_evaluator', description='Applies hashcat rules to attack wordlists and measures hit rate on target wordlists.')
+    parser.add_argument('--rulefile', nargs=1, required=True)
+    parser.add_argument('--attack', nargs='+', required=True) #attack wordlists or directories of them, e.g. dictionaries/evolution/1_attack
+    parser.add_argument('--target', nargs='+', required=True) #target wordlists or directories of them, e.g. dictionaries/evolution/2_target
+    parser.add_argument('--most_frequent', type=int) #evaluate only first rules of file
+    parser.add_argument('--jobs', type=int, default=1) #number of processes applying rules, 0 uses all cores
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    try:
+        rule_lines = load_rules(args.rulefile[0])[:args.most_frequent]
+        attack_words = [word for path in args.attack for word in load_words(path)]
+        targets = {}
+        for path in args.target:
+            for target_path in wordlist_paths(path):
+                targets[target_path] = set(load_words(target_path))
+    except OSError as error:
+        print(f'Cannot read wordlist: {error}', file=sys.stderr)
+        exit(1)
+
+    valid_lines = []
+    for line in rule_lines:
+        try:
+            parse_rule(line)
+            valid_lines.append(line)
+        except ValueError as error:
+            if args.verbose:
+                print(f'Skipped rule: {error}', file=sys.stderr)
+    if args.verbose:
+        print(f'{len(valid_lines)} rules, {len(rule_lines) - len(valid_lines)} skipped, {len(set(attack_words))} attack words', file=sys.stderr)
+
+    start = time.perf_counter()
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    all_targets = set().union(*targets.values())
+    cracked = evaluate_rules(valid_lines, attack_words, all_targets, jobs)
+    if args.verbose:
+        print(f'Evaluated in {time.perf_counter() - start:.3f} s', file=sys.stderr)
+
+    hit_rates = []
+    print('target,passwords,cracked,hit_rate')
+    for path, passwords in targets.items():
+        hits = len(cracked & passwords)
+        hit_rates.append(hits / len(passwords) if passwords else 0.0)
+        print(f'{path},{len(passwords)},{hits},{hit_rates[-1]:.2%}')
+    print(f'average,{len(all_targets)},{len(cracked)},{sum(hit_rates) / len(hit_rates):.2%}')
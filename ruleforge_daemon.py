@@ -0,0 +1,189 @@
+import argparse
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import redirect_stderr, redirect_stdout
+
+from RuleForge import RuleGenerator
+
+
+#modules RuleForge imports only for selected clustering method, the daemon imports them once for all workers
+WARM_MODULES = ['sklearn.cluster', 'scipy.sparse', 'scipy.sparse.csgraph', 'symspellpy', 'symspellpy.editdistance']
+
+#state kept by each worker process between jobs, workers are forked after the default priority is compiled
+#rule priority file -> (rules_priority, rule_search, fingerprint), None is the default priority
+_priority_tables = {}
+#memo of generate_hashcat_rules shared by jobs of worker, entries are keyed by rule priority fingerprint
+_rule_cache = OrderedDict()
+
+
+#key of rule priority table, changed file is compiled again, missing file gives default priority
+def priority_key(path):
+    if path is None:
+        return None
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path), file_stat.st_mtime_ns, file_stat.st_size)
+
+#rule priority of generator compiled once per worker and priority file
+def load_priority(generator):
+    key = priority_key(generator.rule_priority_file)
+    if key not in _priority_tables:
+        generator.create_priority_dict_with_functions()
+        _priority_tables[key] = (generator.rules_priority, generator.rule_search, generator.rule_priority_fingerprint)
+    generator.rules_priority, generator.rule_search, generator.rule_priority_fingerprint = _priority_tables[key]
+
+#one RuleForge.py run in worker process, args are its command line arguments
+#passwords are written to temporary wordlist, clusters (JSON text or object) are read by --stdin
+#output of the run is captured, exit of RuleForge is reported as failed job
+def run_job(args, passwords=None, clusters=None):
+    start = time.perf_counter()
+    output = io.StringIO()
+    wordlist = None
+    generator = RuleGenerator()
+    status = 'ok'
+    try:
+        if passwords is not None:
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8', errors='surrogateescape') as file:
+                file.write('\n'.join(passwords) + '\n')
+                wordlist = file.name
+            args = args + ['--wordlist', wordlist]
+        stdin = sys.stdin
+        sys.stdin = io.StringIO(clusters if isinstance(clusters, str) else json.dumps(clusters) if clusters is not None else '')
+        try:
+            with redirect_stdout(output), redirect_stderr(output):
+                generator.process_args(args)
+                if wordlist is not None:
+                    #cache next to temporary wordlist could never be reused
+                    generator.neighbourhood_cache = False
+                load_priority(generator)
+                generator.rule_cache = _rule_cache
+                generator.process_passwords()
+                if generator.profile is not None:
+                    generator.save_profile()
+        finally:
+            sys.stdin = stdin
+    except SystemExit as error:
+        status = 'ok' if error.code in (None, 0) else 'error'
+    except Exception as error:
+        status = 'error'
+        output.write(f'{type(error).__name__}: {error}\n')
+    finally:
+        if wordlist is not None:
+            os.remove(wordlist)
+    return {
+        'status': status,
+        'rulefile': generator.rule_file,
+        'rules': sum(generator.rules.values()),
+        'distinct_rules': len(generator.rules),
+        'rule_cache_hits': generator.rule_cache_hits,
+        'rule_cache_misses': generator.rule_cache_misses,
+        'seconds': time.perf_counter() - start,
+        'output': output.getvalue(),
+    }
+
+
+#jobs of all clients run by pool of warm worker processes
+class JobServer:
+    def __init__(self, workers, rule_priority_files=()):
+        #modules and priorities are loaded before workers are forked, so workers start with them
+        for module in WARM_MODULES:
+            importlib.import_module(module)
+        for path in [None, *rule_priority_files]:
+            generator = RuleGenerator()
+            generator.rule_priority_file = path
+            load_priority(generator)
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+
+    #job request is JSON object {"id": ..., "args": [...], "passwords": [...], "clusters": ...}
+    #respond is called with response object when job is done, also from another thread
+    def submit(self, line, respond):
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('job must be JSON object')
+            args = request.get('args')
+            if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+                raise ValueError('args must be list of strings')
+            passwords = request.get('passwords')
+            if passwords is not None and not (isinstance(passwords, list) and all(isinstance(password, str) for password in passwords)):
+                raise ValueError('passwords must be list of strings')
+        except ValueError as error:
+            respond({'id': None, 'status': 'error', 'output': f'Invalid job: {error}\n'})
+            return None
+        job_id = request.get('id')
+        future = self.executor.submit(run_job, args, passwords, request.get('clusters'))
+
+        def done(future):
+            try:
+                response = future.result()
+            except Exception as error:
+                response = {'status': 'error', 'output': f'{type(error).__name__}: {error}\n'}
+            respond({'id': job_id, **response})
+        future.add_done_callback(done)
+        return future
+
+    #jobs are read from lines of file, responses are written as lines in order of completion
+    #returns after all jobs of file are done
+    def serve_stream(self, reader, writer):
+        lock = threading.Lock()
+
+        def respond(response):
+            with lock:
+                writer.write(json.dumps(response) + '\n')
+                writer.flush()
+        futures = [self.submit(line, respond) for line in reader if line.strip()]
+        wait([future for future in futures if future is not None])
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        reader = io.TextIOWrapper(self.rfile, encoding='utf-8', errors='surrogateescape')
+        writer = io.TextIOWrapper(self.wfile, encoding='utf-8', errors='surrogateescape')
+        self.server.jobs.serve_stream(reader, writer)
+        writer.detach()
+        reader.detach()
+
+
+#long-running RuleForge that keeps modules, compiled rule priorities and rule memo loaded between jobs
+#jobs are JSON lines with command line arguments of RuleForge.py, read from stdin or from clients of unix socket
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='ruleforge_daemon', description='Runs RuleForge jobs in warm worker processes.')
+    parser.add_argument('--socket', nargs=1) #listen on unix socket instead of stdin, each connection sends its own jobs
+    parser.add_argument('--workers', type=int, default=0) #number of jobs run at once, 0 uses all cores
+    parser.add_argument('--rule_priority', nargs='+', default=[]) #rule priority files compiled before workers start
+    args = parser.parse_args()
+
+    jobs = JobServer(args.workers if args.workers > 0 else (os.cpu_count() or 1), args.rule_priority)
+    try:
+        if args.socket:
+            #socket left by previous daemon is replaced, other files are not
+            if os.path.exists(args.socket[0]) and stat.S_ISSOCK(os.stat(args.socket[0]).st_mode):
+                os.remove(args.socket[0])
+            with socketserver.ThreadingUnixStreamServer(args.socket[0], JobHandler) as server:
+                server.jobs = jobs
+                try:
+                    server.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os.remove(args.socket[0])
+        else:
+            jobs.serve_stream(sys.stdin, sys.stdout)
+    finally:
+        jobs.shutdown()
@@ -0,0 +1,22 @@
+import numpy as np
+
+from rule_evaluator import load_words, wordlist_paths
+
+
+#files RuleForge writes next to wordlists are not read as words
+def test_directory_reads_only_wordlists(tmp_path):
+    (tmp_path / 'b.txt').write_text('password\nletmein\n')
+    (tmp_path / 'a.txt').write_text('123456\n')
+    (tmp_path / '.MDBSCANcache.1.a.txt.bin').write_bytes(b'RFNBHD\x00\x01' + bytes(64))
+    np.save(tmp_path / 'a_distance_matrix.npy', np.zeros((2, 2), dtype=np.int8))
+    (tmp_path / 'subdirectory.txt').mkdir()
+
+    assert wordlist_paths(str(tmp_path)) == [str(tmp_path / 'a.txt'), str(tmp_path / 'b.txt')]
+    assert load_words(str(tmp_path)) == ['123456', 'password', 'letmein']
+
+
+def test_file_is_its_own_wordlist(tmp_path):
+    (tmp_path / 'words.lst').write_text('dragon\n\nmonkey\n')
+
+    assert wordlist_paths(str(tmp_path / 'words.lst')) == [str(tmp_path / 'words.lst')]
+    assert load_words(str(tmp_path / 'words.lst')) == ['dragon', 'monkey']
@@ -0,0 +1,27 @@
+from RuleForge import RuleGenerator
+
+
+#distances above the int8 range of distance matrix must not make far passwords look close
+def test_cluster_medoid_ignores_far_long_passwords():
+    passwords = ['password', 'password1', 'passw0rd', 'x' * 150, 'y' * 150]
+
+    assert RuleGenerator().cluster_medoid(passwords) == 0
+
+
+#wordlists of batch are listed once, generator of each wordlist gets parsed arguments with its own files
+def test_batch_generator_does_not_list_directory_again(tmp_path, monkeypatch):
+    for name in ['a.txt', 'b.txt']:
+        (tmp_path / name).write_text('password\npassword1\n')
+    generator = RuleGenerator()
+    generator.process_args(['--wordlist_dir', str(tmp_path), '--rulefile', str(tmp_path / 'rules.rule'), '--save_clusters', str(tmp_path / 'clusters.json'), '--hac', '--representative', 'combo'])
+
+    def list_wordlists(directory):
+        raise AssertionError('directory of batch listed again')
+    monkeypatch.setattr(RuleGenerator, 'list_wordlists', staticmethod(list_wordlists))
+    batch_generator = generator.batch_generator(str(tmp_path / 'b.txt'))
+
+    assert batch_generator.batch_wordlists is None
+    assert batch_generator.wordlist == str(tmp_path / 'b.txt')
+    assert batch_generator.rule_file == str(tmp_path / 'rules.b.rule')
+    assert batch_generator.clusters_file == str(tmp_path / 'clusters.b.json')
+    assert batch_generator.HAC and batch_generator.distance_threshold == 3